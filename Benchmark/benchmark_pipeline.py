@@ -0,0 +1,194 @@
+# -*- coding:utf-8 -*-
+"""
+拓扑分析流水线的性能测试：对每个阶段分别记录耗时和内存峰值
+    clean_trace_data        IpTraceFileV2.clean_trace_data
+    extract_trace_data      IpTraceFileV2.extract_trace_data
+    update_prefix_distance  IpTopo.update_prefix_distance
+    generate_block_topo     IpTopo.generate_block_topo
+    load_trace_file         SubnetInference的clean_trace_data + load_trace_file
+
+每个阶段都在独立的子进程中运行：
+    1. 两个build_ip_topo_graph模块同名，且对Util的导入方式不同，不能在同一个进程中加载
+    2. 子进程的内存峰值（ru_maxrss）不受其他阶段的影响
+阶段内的内存峰值用tracemalloc单独测一次，不影响计时
+
+example:
+    python benchmark_pipeline.py --scale 1M --repeat 3 --output results.jsonl
+"""
+
+import sys
+import os.path
+import json
+import time
+import platform
+import argparse
+import resource
+import tracemalloc
+import subprocess
+import importlib.util
+import generate_synthetic_trace
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+STAGES = ['clean_trace_data',
+          'extract_trace_data',
+          'update_prefix_distance',
+          'generate_block_topo',
+          'load_trace_file']
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_ip_block_topo():
+    sys.path.insert(0, ROOT)
+    return load_module('ip_block_topo', os.path.join(ROOT, 'IPBlockTopo', 'build_ip_topo_graph.py'))
+
+
+def load_subnet_inference():
+    sys.path.insert(0, os.path.join(ROOT, 'Util'))
+    return load_module('subnet_inference', os.path.join(ROOT, 'SubnetInference', 'build_ip_topo_graph.py'))
+
+
+def build_graph(ipb, files, int_nodes):
+    link_set = ipb.IpTraceFileV2(files['nmap'], int_nodes=int_nodes).extract_trace_data()
+    g = ipb.IpTopo(int_nodes=int_nodes)
+    g.add_edges_from(link_set.keys())
+    return g
+
+
+def stage_functions(stage, files, th, int_nodes):
+    """
+    :return prepare: 每次运行前调用（不计时），返回run的参数
+    :return run: 被测函数
+    """
+    if stage == 'clean_trace_data':
+        ipb = load_ip_block_topo()
+        tf = ipb.IpTraceFileV2(files['nmap'], int_nodes=int_nodes)
+        return lambda: None, lambda _: tf.clean_trace_data(lazy=False)
+
+    if stage == 'extract_trace_data':
+        ipb = load_ip_block_topo()
+        tf = ipb.IpTraceFileV2(files['nmap'], int_nodes=int_nodes)
+        tf.clean_trace_data(lazy=True)
+        return lambda: None, lambda _: tf.extract_trace_data()
+
+    if stage == 'update_prefix_distance':
+        ipb = load_ip_block_topo()
+        g = build_graph(ipb, files, int_nodes)
+        return lambda: g, lambda graph: graph.update_prefix_distance()
+
+    if stage == 'generate_block_topo':
+        ipb = load_ip_block_topo()
+        g = build_graph(ipb, files, int_nodes)
+        g.update_prefix_distance()
+        # generate_block_topo会修改原图，每次运行前复制一份
+        return lambda: g.copy(), lambda graph: graph.generate_block_topo(th)
+
+    if stage == 'load_trace_file':
+        si = load_subnet_inference()
+
+        def run(_):
+            stat, clnfile = si.clean_trace_data(trfile=files['tab'], lazy=False)
+            return si.load_trace_file(trfile=clnfile)
+        return lambda: None, run
+
+    raise ValueError('Unknown stage: ' + stage)
+
+
+def run_stage(stage, files, th, int_nodes, repeat):
+    """
+    在当前进程中测试一个阶段（由子进程调用）
+
+    :return result: dict
+        seconds: 最快一次的耗时
+        peak_mb: 阶段内Python/numpy内存分配的峰值（tracemalloc）
+        maxrss_mb: 进程的内存峰值（包括准备数据）
+    """
+    prepare, run = stage_functions(stage, files, th, int_nodes)
+    timings = []
+    for _ in range(repeat):
+        arg = prepare()
+        t0 = time.perf_counter()
+        run(arg)
+        timings.append(time.perf_counter() - t0)
+
+    arg = prepare()
+    tracemalloc.start()
+    run(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        maxrss *= 1024
+    return {'stage': stage,
+            'seconds': min(timings),
+            'peak_mb': peak / 2.0 ** 20,
+            'maxrss_mb': maxrss / 2.0 ** 20}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    files = generate_synthetic_trace.generate(args.datadir, args.scale, seed=args.seed)
+    num_hops = generate_synthetic_trace.parse_scale(args.scale)
+    stages = args.stages.split(',') if args.stages else STAGES
+
+    results = []
+    print('{0:<24}{1:>12}{2:>16}{3:>12}{4:>14}'.format('stage', 'seconds', 'hops/sec', 'peak MB', 'maxrss MB'))
+    for stage in stages:
+        cmd = [sys.executable, os.path.abspath(__file__), '--child', stage,
+               '--datadir', args.datadir, '--scale', args.scale, '--seed', str(args.seed),
+               '--th', str(args.th), '--repeat', str(args.repeat)]
+        if args.int_nodes:
+            cmd.append('--int-nodes')
+        output = subprocess.check_output(cmd, cwd=os.path.dirname(os.path.abspath(__file__)))
+        result = json.loads(output.decode().strip().split('\n')[-1])
+        results.append(result)
+        print('{0:<24}{1:>12.3f}{2:>16,.0f}{3:>12.1f}{4:>14.1f}'.format(
+            stage, result['seconds'], num_hops / max(result['seconds'], 1e-9), result['peak_mb'], result['maxrss_mb']))
+
+    if args.output:
+        record = {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                  'revision': git_revision(),
+                  'python': platform.python_version(),
+                  'scale': args.scale,
+                  'num_hops': num_hops,
+                  'seed': args.seed,
+                  'th': args.th,
+                  'int_nodes': args.int_nodes,
+                  'results': results}
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the topology pipeline stage by stage.')
+    parser.add_argument('--datadir', default='./data/', help='directory of the synthetic trace files')
+    parser.add_argument('--scale', default='100k', help='total number of hops, e.g. 10k, 1M, 10M')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic data')
+    parser.add_argument('--th', type=int, default=8, help='prefix threshold of generate_block_topo')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs per stage')
+    parser.add_argument('--int-nodes', action='store_true', help='use integer node IDs')
+    parser.add_argument('--stages', default='', help='comma separated stages, default: all')
+    parser.add_argument('--output', default='', help='append the results as one json line to this file')
+    parser.add_argument('--child', default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        files = generate_synthetic_trace.generate(args.datadir, args.scale, seed=args.seed)
+        print(json.dumps(run_stage(args.child, files, args.th, args.int_nodes, args.repeat)))
+    else:
+        main(args)
@@ -0,0 +1,191 @@
+# -*- coding:utf-8 -*-
+"""
+生成可复现的合成traceroute数据，用于拓扑分析流水线的性能测试
+    同时支持两种文件格式：
+        nmap: IPBlockTopo/IpTraceFileV2使用的格式
+        tab: SubnetInference使用的格式
+    规模用总跳数表示（比如10k ~ 10M），相同的seed总是生成相同的文件
+"""
+
+import os.path
+import random
+import argparse
+import ipaddress
+
+
+def write_lines(lines, filename):
+    """
+    与Util.write_lines相同
+        这里不导入Util：IPBlockTopo和SubnetInference导入Util的方式不同，
+        性能测试的子进程需要分别加载二者，不能预先占用模块名Util
+    """
+    count = 0
+    with open(filename, 'w') as f:
+        for line in lines:
+            if count > 0:
+                f.write('\n')
+            f.write(line)
+            count += 1
+    return count
+
+
+def parse_scale(scale):
+    """
+    example:
+        parse_scale('10k') -> 10000
+        parse_scale('2.5M') -> 2500000
+    """
+    scale = str(scale).strip()
+    units = {'k': 10 ** 3, 'm': 10 ** 6, 'g': 10 ** 9}
+    if scale and scale[-1].lower() in units:
+        return int(float(scale[:-1]) * units[scale[-1].lower()])
+    return int(scale)
+
+
+class SyntheticTopology(object):
+    """
+    一个简单的分层网络：vantage point -> 私有网关 -> 骨干网 -> 汇聚层 -> 目标网络
+        路由器接口按/24分组分配，便于IP block聚类；
+        同一目标前缀的路径基本相同，少量主机经过负载均衡的另一条支路；
+        部分跳为匿名（*）、私有地址或者末尾连续的*，以覆盖预处理的各个分支
+    """
+    def __init__(self, seed=0, num_prefixes=1024, num_backbone=2048, anonymous_rate=0.08):
+        self.rand = random.Random(seed)
+        self.anonymous_rate = anonymous_rate
+        self.vantage_points = ['10.42.0.%d' % i for i in range(1, 9)]
+        self.gateways = ['10.42.0.254', '192.168.1.1']
+        self.backbone = [self.__router() for _ in range(num_backbone)]
+        self.prefixes = [ipaddress.IPv4Network('%d.%d.%d.0/24' % (self.rand.randint(1, 223),
+                                                                    self.rand.randint(0, 255),
+                                                                    self.rand.randint(0, 255)))
+                         for _ in range(num_prefixes)]
+        # 每个目标前缀的主路径和负载均衡支路
+        self.routes = {}
+
+    def __router(self):
+        # 路由器接口集中在少量/24中
+        return '%d.%d.%d.%d' % (self.rand.choice([58, 61, 202, 203, 210, 219]),
+                                self.rand.randint(0, 7),
+                                self.rand.randint(0, 31),
+                                self.rand.randint(1, 254))
+
+    def __route(self, prefix):
+        route = self.routes.get(prefix)
+        if route is None:
+            length = self.rand.randint(6, 14)
+            primary = self.rand.sample(self.backbone, length)
+            alternate = list(primary)
+            alternate[length // 2] = self.rand.choice(self.backbone)
+            edge = str(prefix.network_address + 1)
+            route = self.routes[prefix] = (primary + [edge], alternate + [edge])
+        return route
+
+    def random_destination(self, prefix=None):
+        prefix = prefix or self.rand.choice(self.prefixes)
+        return str(prefix.network_address + self.rand.randint(2, prefix.num_addresses - 2)), prefix
+
+    def trace(self, dst, prefix):
+        """
+        :return rtpath: list of strings
+        :return rtts: list of strings
+        :return reached: boolean
+        """
+        primary, alternate = self.__route(prefix)
+        route = primary if self.rand.random() < 0.8 else alternate
+        rtpath = [self.rand.choice(self.gateways)] + route
+        reached = self.rand.random() < 0.6
+        if reached:
+            rtpath.append(dst)
+        rtpath = ['*' if self.rand.random() < self.anonymous_rate else h for h in rtpath]
+        if not reached:
+            rtpath.extend(['*'] * self.rand.randint(0, 6))
+        rtts, rtt = [], 0.2
+        for h in rtpath:
+            rtt += self.rand.expovariate(1.0 / 3)
+            rtts.append('*' if h == '*' else '%.2f' % rtt)
+        return rtpath, rtts, reached
+
+
+def generate_nmap_trace_file(filename, num_hops, seed=0, **kwargs):
+    """
+    生成IpTraceFileV2格式的文件，总跳数约为>num_hops<
+
+    :return num_traces: int
+    """
+    topo = SyntheticTopology(seed=seed, **kwargs)
+    head = ['# TOOL:NMAP',
+            '# PRO:UDP',
+            '# TIME:2018-05-24 15:04:08',
+            '# DST,VantagePoint,HOP:MS......']
+
+    def lines():
+        for line in head:
+            yield line
+        count = 0
+        while count < num_hops:
+            dst, prefix = topo.random_destination()
+            rtpath, rtts, _ = topo.trace(dst, prefix)
+            count += len(rtpath)
+            yield '{0},{1},{2}'.format(dst, topo.rand.choice(topo.vantage_points),
+                                       ' '.join([h + ':' + r for h, r in zip(rtpath, rtts)]))
+
+    return write_lines(lines(), filename) - len(head)
+
+
+def generate_tab_trace_file(filename, num_hops, seed=0, prefix_length=16, **kwargs):
+    """
+    生成SubnetInference格式的文件（单个目标网络），总跳数约为>num_hops<
+
+    :return num_traces: int
+    """
+    topo = SyntheticTopology(seed=seed, **kwargs)
+    dst_net = topo.prefixes[0].supernet(new_prefix=prefix_length)
+    subnets = list(dst_net.subnets(new_prefix=24))
+    max_ttl = 30
+    head = ['Vantage:\t' + topo.vantage_points[0],
+            'Destination:\t' + str(dst_net),
+            'TTL:\t' + ' '.join([str(t) for t in range(1, max_ttl + 1)])]
+
+    def lines():
+        for line in head:
+            yield line
+        count = 0
+        while count < num_hops:
+            dst, prefix = topo.random_destination(topo.rand.choice(subnets))
+            rtpath, _, reached = topo.trace(dst, prefix)
+            rtpath = (rtpath + ['*'] * max_ttl)[:max_ttl] if not reached else rtpath
+            count += len(rtpath)
+            yield ('+' if reached else '-') + dst + ':\t' + ' '.join(rtpath)
+
+    return write_lines(lines(), filename) - len(head)
+
+
+def generate(datadir, scale, seed=0):
+    """
+    在>datadir<中生成两种格式的数据文件（若已存在则直接使用）
+
+    :return files: dict
+        'nmap': IpTraceFileV2格式的文件名
+        'tab': SubnetInference格式的文件名
+    """
+    num_hops = parse_scale(scale)
+    if not os.path.exists(datadir):
+        os.makedirs(datadir)
+    files = {'nmap': os.path.join(datadir, 'synthetic_{0}_seed{1}.csv'.format(scale, seed)),
+             'tab': os.path.join(datadir, 'synthetic_{0}_seed{1}.trace'.format(scale, seed))}
+    if not os.path.exists(files['nmap']):
+        print('Generate \"{0}\": {1} traces'.format(files['nmap'],
+                                                    generate_nmap_trace_file(files['nmap'], num_hops, seed=seed)))
+    if not os.path.exists(files['tab']):
+        print('Generate \"{0}\": {1} traces'.format(files['tab'],
+                                                    generate_tab_trace_file(files['tab'], num_hops, seed=seed)))
+    return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic traceroute files for benchmarking.')
+    parser.add_argument('--datadir', default='./data/', help='output directory')
+    parser.add_argument('--scale', default='100k', help='total number of hops, e.g. 10k, 1M, 10M')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    generate(args.datadir, args.scale, seed=args.seed)
@@ -3,18 +3,68 @@
 import networkx
 import ipaddress
 import os.path
+from array import array
 from enum import Enum, unique
+from collections import deque
+from itertools import chain, groupby, islice
 from operator import itemgetter
 # import matplotlib.pyplot as plt
 import numpy as np
-import copy
+import multiprocessing
+from functools import partial
 import Util.Util as Util
+import Util.Util_ip as Util_ip
+import Util.Util_cache as Util_cache
+import Util.Util_graph as Util_graph
+import Util.Util_bintrace as Util_bintrace
 
 
 def get_ip_block(ip, prefix_length):
     return str(ipaddress.IPv4Network(ip + '/' + str(prefix_length), strict=False))
 
 
+def get_ip_block_int(ip, prefix_length):
+    """
+    整数模式下的IP block节点：(网络地址, 前缀长度)
+
+    example:
+        get_ip_block_int(167772417, 24) -> (167772416, 24)
+    """
+    return ip & Util_ip.prefix_mask(prefix_length), prefix_length
+
+
+def node_address(n):
+    """
+    返回节点的（网络）地址，用整数表示
+        可同时兼容以下几种节点：
+            '10.0.1.1', '10.0.1.0/24'：字符串模式下的IP节点和IP block节点
+            167772417, (167772416, 24)：整数模式下的IP节点和IP block节点
+    """
+    if isinstance(n, int):
+        return n
+    if isinstance(n, tuple):
+        return n[0]
+    return Util_ip.ip_to_int(n.split('/', 1)[0])
+
+
+def node_prefix_length(n):
+    """ 返回节点的前缀长度，IP节点为32，参见node_address """
+    if isinstance(n, int):
+        return 32
+    if isinstance(n, tuple):
+        return n[1]
+    return int(n.split('/', 1)[1]) if '/' in n else 32
+
+
+def node_to_str(n):
+    """ 将节点转换为便于阅读的字符串，字符串模式下的节点保持不变 """
+    if isinstance(n, int):
+        return Util_ip.int_to_ip(n)
+    if isinstance(n, tuple):
+        return Util_ip.int_to_ip(n[0]) + '/' + str(n[1])
+    return n
+
+
 def prefix_distance(first, second):
     """Compute the prefix distance between two IPv4 addresses
 
@@ -27,8 +77,78 @@ def prefix_distance(first, second):
     :param second: the second ipaddress.IPv4Address object
     :return: the prefix distance
     """
-    first, second = int(first), int(second)
-    return 0 if first == second else len(bin(first ^ second)) - 2
+    return (int(first) ^ int(second)).bit_length()
+
+
+def prefix_distance_array(first, second):
+    """
+    批量计算前缀距离，prefix_distance的向量化版本
+
+    :param first: numpy.ndarray of uint32
+    :param second: numpy.ndarray of uint32
+    :return: numpy.ndarray of int
+        xor的二进制位数；frexp对正整数返回的指数恰好是其位数，且frexp(0)的指数为0
+    """
+    xor = np.bitwise_xor(np.asarray(first, dtype=np.uint32), np.asarray(second, dtype=np.uint32))
+    return np.frexp(xor.astype(np.float64))[1]
+
+
+def prefix_clusters(nodes, th):
+    """
+    将节点按前缀聚类：两个节点的前缀距离不超过>th<，当且仅当二者地址右移>th<位后相等，
+    因此“距离<=th”是等价关系，排序后一次线性扫描即可得到全部类，复杂度O(n log n)
+        与反复调用IpTopo.pop_one_clique得到的block完全相同（后者是O(n^2)）
+
+    :param nodes: iterable
+        节点（字符串或者整数模式，参见node_address）
+    :param th: int
+        前缀距离阈值
+    :return clusters: list of (nodes_in_clique, max_prefix_dist)
+        max_prefix_dist是类内任意两个节点之间前缀距离的最大值，
+        排序后就是类内最小地址和最大地址的前缀距离
+    """
+    items = sorted(((node_address(n), n) for n in nodes), key=itemgetter(0))
+    clusters = []
+    for _, group in groupby(items, key=lambda x: x[0] >> th):
+        group = list(group)
+        clusters.append(([n for _, n in group], prefix_distance(group[0][0], group[-1][0])))
+    return clusters
+
+
+class PrefixDendrogram(object):
+    """
+    所有阈值下的前缀聚类（参见prefix_clusters）构成一棵层次树：
+    地址排序后，相邻两个地址的前缀距离就是二者在树中合并的高度，
+    阈值为th时，在相邻距离大于th的位置切开，得到的每一段就是一个类
+        只需排序一次，之后对任意阈值都可以线性时间得到全部类，且不必复制或修改原图
+    """
+    def __init__(self, nodes):
+        nodes = list(nodes)
+        addresses = np.fromiter((node_address(n) for n in nodes), dtype=np.uint32, count=len(nodes))
+        order = np.argsort(addresses, kind='stable')
+        self.addresses = addresses[order]
+        self.nodes = [nodes[i] for i in order.tolist()]
+        # 相邻地址的前缀距离，即合并高度
+        self.heights = prefix_distance_array(self.addresses[:-1], self.addresses[1:])
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def thresholds(self):
+        """ 聚类结果发生变化的全部阈值，升序 """
+        return np.unique(self.heights).tolist()
+
+    def clusters(self, th):
+        """
+        :return clusters: list of (nodes_in_clique, max_prefix_dist)
+            与prefix_clusters(nodes, th)相同
+        """
+        if not self.nodes:
+            return []
+        starts = np.concatenate(([0], np.flatnonzero(self.heights > th) + 1))
+        stops = np.concatenate((starts[1:], [len(self.nodes)]))
+        max_dists = prefix_distance_array(self.addresses[starts], self.addresses[stops - 1]).tolist()
+        return [(self.nodes[start:stop], d) for start, stop, d in zip(starts.tolist(), stops.tolist(), max_dists)]
 
 
 def delay_distance(d1, d2, bins=range(0, 501)):
@@ -57,11 +177,114 @@ def delay_distance(d1, d2, bins=range(0, 501)):
     return delta
 
 
+def rtt_cdf(rtts, bins=range(0, 501)):
+    """
+    时延的cdf，与delay_distance中的计算方法相同
+        若没有落在>bins<范围内的时延，返回全为nan的向量
+
+    :param rtts: iterable of float
+    :return: numpy.ndarray, 长度为len(bins) - 1
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hist, _ = np.histogram(np.asarray(rtts, dtype=np.float64), bins=bins, density=True)
+    return np.cumsum(hist)
+
+
+def iter_delay_distance_blocks(areas, chunk_size=4096):
+    """
+    按行分块计算delay_distance：第i行第j列等于delay_distance(d_i, d_j)
+        delay_distance是两条cdf之差的和，所以等于两条cdf各自求和之后的差：
+        D[i, j] = sum(cdf_j) - sum(cdf_i)，只需要每个节点的cdf之和>areas<即可得到整个矩阵
+        每次只生成>chunk_size<行，内存占用为O(chunk_size * n)
+
+    :param areas: numpy.ndarray, shape = (n,)
+        每个节点的cdf之和，参见RttCdfTable.areas；nan表示该节点没有有效的时延数据
+    :param chunk_size: int
+        每块的行数
+    :return: generator of (start, block)
+        block: numpy.ndarray, shape = (rows, n), dtype = float32, 矩阵的第start行到第start + rows - 1行
+        无效节点所在的行、列均为nan
+    """
+    areas = np.asarray(areas, dtype=np.float64)
+    n = len(areas)
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        block = np.empty((stop - start, n), dtype=np.float32)
+        np.subtract(areas[np.newaxis, :], areas[start:stop, np.newaxis], out=block, casting='same_kind')
+        yield start, block
+
+
+def delay_distance_matrix(areas, chunk_size=4096, out=None):
+    """
+    批量计算delay_distance，参见iter_delay_distance_blocks
+
+    :param out: numpy.ndarray, shape = (n, n)
+        结果写入>out<，可以是numpy.memmap，此时内存中只保留一块；None表示新分配一个矩阵
+    :return: numpy.ndarray, shape = (n, n)
+    """
+    n = len(areas)
+    if out is None:
+        out = np.empty((n, n), dtype=np.float32)
+    for start, block in iter_delay_distance_blocks(areas, chunk_size=chunk_size):
+        out[start:start + len(block)] = block
+    return out
+
+
+class RttCdfTable(object):
+    """
+    缓存每个节点的时延cdf之和，代替在delay_distance中对每一对节点重复计算直方图
+        delay_distance只用到每条cdf之和，所以每个节点只保存一个float64，不保存cdf本身
+    """
+    def __init__(self, node2rtts, bins=range(0, 501)):
+        """
+        :param node2rtts: dict
+            key: node
+            value: iterable of float, 参见IpTraceFileV2.extract_node_rtts
+        """
+        self.bins = bins
+        self.nodes = list(node2rtts)
+        self.index = {n: i for i, n in enumerate(self.nodes)}
+        self.areas = np.empty(len(self.nodes), dtype=np.float64)
+        for i, n in enumerate(self.nodes):
+            self.areas[i] = rtt_cdf(node2rtts[n], bins=bins).sum()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def distance(self, first, second):
+        """ 与delay_distance(rtts of first, rtts of second)相同 """
+        return float(self.areas[self.index[second]] - self.areas[self.index[first]])
+
+    def __areas(self, nodes):
+        return self.areas if nodes is None else self.areas[[self.index[n] for n in nodes]]
+
+    def distance_blocks(self, nodes=None, chunk_size=4096):
+        """
+        按行分块计算候选节点集合中两两之间的delay_distance
+
+        :param nodes: list
+            候选节点，None表示全部节点
+        :return: generator, 参见iter_delay_distance_blocks
+        """
+        return iter_delay_distance_blocks(self.__areas(nodes), chunk_size=chunk_size)
+
+    def distance_matrix(self, nodes=None, chunk_size=4096, out=None):
+        """
+        计算候选节点集合中两两之间的delay_distance
+
+        :param nodes: list
+            候选节点，None表示全部节点
+        :return: numpy.ndarray, 参见delay_distance_matrix
+        """
+        return delay_distance_matrix(self.__areas(nodes), chunk_size=chunk_size, out=out)
+
+
 @unique
 class FileType(Enum):
     """ denote the version of the traceroute result file """
     original = 0
     cleaned = 1
+    binary = 2
 
 
 class IpTraceFileBase(object):
@@ -70,13 +293,16 @@ class IpTraceFileBase(object):
         # 判断文件类型:
         # original是原始数据；
         # cleaned是预处理后的数据，但是数据格式和原始数据一致
+        # binary是列式存储的二进制数据（参见Util_bintrace），可能经过预处理，也可能没有
         self.type = FileType.original
         if filename.endswith('_cln'):
             self.type = FileType.cleaned
+        elif filename.endswith('.btr'):
+            self.type = FileType.binary
 
         if self.type == FileType.original:
             self.__cln_filename = self.__org_filename + '_cln'
-        elif self.type == FileType.cleaned:
+        else:
             self.__cln_filename = self.__org_filename
 
         self.version = -1
@@ -116,7 +342,7 @@ class IpTraceFileBase(object):
         # 该路径至少包含两个IP地址
         if len(rtpath) > 1:
             # 判断每个非匿名IP是否只出现一次
-            ip_non_anonymous_list = list(filter(lambda x: x != '*', rtpath))
+            ip_non_anonymous_list = list(filter(lambda x: x != '*' and x != '?', rtpath))
             if len(ip_non_anonymous_list) < 2:
                 vprint('Invalid: A valid routing path must contain at least two non-anonymous IPs.')
                 return False
@@ -124,7 +350,7 @@ class IpTraceFileBase(object):
             if len(ip_non_anonymous_list) == len(set(ip_non_anonymous_list)):
                 # 没有重复出现的IP地址，也就是没有路由环路
                 for i in range(len(rtpath) - 1):
-                    if rtpath[i] != '*' and rtpath[i + 1] != '*':
+                    if rtpath[i] not in ('*', '?') and rtpath[i + 1] not in ('*', '?'):
                         # 存在连续两个非匿名IP地址，该路径包含至少一条链路，于是valid
                         return True
             else:
@@ -140,6 +366,7 @@ class IpTraceFileBase(object):
         根据一条路由路径抽取IP链路
             e.g. (x.x.x.a -> x.x.x.b) => 返回{(x.x.x.a, x.x.x.b): (1,)}
                  (x.x.x.a -> * -> x.x.x.b) => 返回{(x.x.x.a, x.x.x.b): (2,)}
+                 (x.x.x.a -> ? -> x.x.x.b) => 没有链路，未探测的跳（?）两侧的IP之间可能隔着任意多跳
 
         :param rtpath: list
             list of IPs
@@ -149,11 +376,14 @@ class IpTraceFileBase(object):
         link2data = {}
         i = 0
         while i < len(rtpath) - 1:
-            if rtpath[i] == '*':
+            if rtpath[i] == '*' or rtpath[i] == '?':
                 i += 1
                 continue
 
             for j in range(i + 1, len(rtpath)):
+                if rtpath[j] == '?':
+                    i = j
+                    break
                 if rtpath[j] != '*':
                     if rtts:
                         link2data[(rtpath[i], rtpath[j])] = [(j - i, float(rtts[i]), float(rtts[j]))]
@@ -161,6 +391,8 @@ class IpTraceFileBase(object):
                         link2data[(rtpath[i], rtpath[j])] = [(j - i,)]
                     i = j
                     break
+            else:
+                break
         return link2data
 
     @staticmethod
@@ -181,6 +413,38 @@ class IpTraceFileBase(object):
             min_length = min(data, key=itemgetter(0))[0]
             link2data[link] = list(filter(lambda x: x[0] == min_length, data))
 
+    @staticmethod
+    def fold_link_counts(link_set, other):
+        """
+        将聚合形式的链路数据>other<（{link: (最小间隔, 次数)}）并入>link_set<，语义与fold_links相同
+
+        :param link_set: dict, 会被修改
+        :param other: dict, extract_trace_data的返回值
+        """
+        for link, (gap, count) in other.items():
+            known = link_set.get(link)
+            if known is None or gap < known[0]:
+                link_set[link] = (gap, count)
+            elif gap == known[0]:
+                link_set[link] = (gap, known[1] + count)
+
+    @staticmethod
+    def fold_links(link_set, link2data):
+        """
+        将一条路径的链路数据>link2data<并入>link_set<，并保持clean_link_data的语义：
+        每条链路只保留间隔最小的数据
+            相当于先全部extend再调用clean_link_data，但不必保存间隔更大的数据
+
+        :param link_set: dict, 会被修改
+        :param link2data: dict, extract_links的返回值
+        """
+        for link, data in link2data.items():
+            known = link_set.get(link)
+            if known is None or data[0][0] < known[0][0]:
+                link_set[link] = list(data)
+            elif data[0][0] == known[0][0]:
+                known.extend(data)
+
 
 class IpTraceFileV1(IpTraceFileBase):
     pass
@@ -197,20 +461,99 @@ class IpTraceFileV2(IpTraceFileBase):
         59.96.18.137,10.42.0.224,10.42.0.1:0.16 110.185.170.129:1.15 125.69.64.213:2.28 ...
         ...
     """
-    def __init__(self, filename):
+    def __init__(self, filename, int_nodes=False):
+        """
+        :param int_nodes: boolean
+            True: 抽取的链路中，IP地址用uint32整数表示（参见IpTopo的整数模式）
+            False: IP地址用点分十进制字符串表示
+        """
         IpTraceFileBase.__init__(self, filename)
         self.version = 2
         self.head_line_length = 4
+        self.intern_table = Util_ip.IpInternTable() if int_nodes else None
 
-    def clean_trace_data(self, lazy=True):
+    @staticmethod
+    def parse_trace_line(line):
+        """
+        解析一行trace数据
+            e.g. 117.194.201.244,10.42.0.224,*:* 110.185.170.129:2.85 220.166.252.137:3.45 ...
+
+        :return items: list of strings, 用','分隔的各个字段
+        :return rtpath: list of strings, 路由路径
+        :return rtts: list of strings, 每一跳的时延
+        """
+        items = line.split(',')
+        trace = items[-1].split(' ')
+        trace = [hop.split(':') for hop in trace]
+        trace = list(zip(*trace))
+        return items, list(trace[0]), list(trace[1])
+
+    def iter_traces(self, filename):
+        """
+        逐行读取trace文件（跳过头部），每次返回一条解析后的路径，内存占用与文件大小无关
+
+        :return: generator of (items, rtpath, rtts), 参见parse_trace_line
+        """
+        for i, line in enumerate(Util.iter_lines(filename)):
+            if i < self.head_line_length:
+                continue
+            yield self.parse_trace_line(line)
+
+    @staticmethod
+    def clean_trace(rtpath, rtts):
         """
-        预处理traceroute探测得到的原始数据文件
+        预处理一条路径
             1. 将非法IP（比如私有IP）替换为匿名IP（用*表示）
             2. 将末尾的匿名IP删除：(a, b, c, d, *, *, *, *) => (a, b, c, d)
-            3. 判断路径是否正常，若异常，直接删除该路径
+            3. 判断路径是否正常
+
+        :return rtpath, rtts: list
+            预处理后的路径和时延；若路径异常，返回None, None
+        """
+        # 1. 替换非法IP
+        rtpath = Util_ip.replace_non_global(rtpath)
+        rtts = [rtts[i] if h != '*' and h != '?' else '*' for i, h in enumerate(rtpath)]
+
+        # 2. 移除末尾的匿名IP（以及未探测的跳）
+        for h in range(1, len(rtpath) + 1):
+            if rtpath[len(rtpath) - h] not in ('*', '?'):
+                break
+        rtpath = rtpath[:len(rtpath) - h + 1]
+        rtts = rtts[:len(rtts) - h + 1]
+
+        # 3. 判断是否正常路径
+        if not IpTraceFileBase.is_valid_trace(rtpath):
+            return None, None
+        return rtpath, rtts
+
+    def iter_cleaned_traces(self):
+        """
+        逐行读取原始数据文件并预处理（参见clean_trace），异常路径直接丢弃
+
+        :return: generator of (line, items, rtpath, rtts)
+            line是预处理后的一行数据；头部各行原样返回，此时items, rtpath, rtts均为None
+        """
+        for i, line in enumerate(Util.iter_lines(self.org_filename())):
+            if i < self.head_line_length:
+                yield line, None, None, None
+                continue
+            # example:
+            #   117.194.201.244,10.42.0.224,*:* 110.185.170.129:2.85 220.166.252.137:3.45 ...
+            items, rtpath, rtts = self.parse_trace_line(line)
+            rtpath, rtts = self.clean_trace(rtpath, rtts)
+            if rtpath is None:
+                continue
+            items[-1] = ' '.join([rtpath[i] + ':' + rtts[i] for i in range(len(rtpath))])
+            yield ','.join(items), items, rtpath, rtts
+
+    def clean_trace_data(self, lazy=True):
+        """
+        预处理traceroute探测得到的原始数据文件，参见clean_trace
+        逐行读取、逐行写出，不会把整个文件读入内存
 
         :param lazy: boolean
-            True: 如果返回文件已经存在，直接跳过，不重新处理
+            True: 如果返回文件已经存在，且原始文件在此之后没有变化（参见Util_cache.FileCache），
+                  直接跳过，不重新处理
             False: 不论返回文件是否已经存在，都重新处理一遍
 
         :return: int
@@ -221,98 +564,650 @@ class IpTraceFileV2(IpTraceFileBase):
         if self.type != FileType.original:
             return -1
 
-        if lazy and os.path.exists(self.cln_filename()):
+        if lazy and self.cache().get('cln'):
             return 0
 
-        lines = Util.read_to_list(self.org_filename())
-        if not lines:
+        traces = self.iter_cleaned_traces()
+        first = next(traces, None)
+        if first is None:
             return -1
 
-        for i in range(self.head_line_length, len(lines)):
-            # example:
-            #   117.194.201.244,10.42.0.224,*:* 110.185.170.129:2.85 220.166.252.137:3.45 ...
-            items = lines[i].split(',')
-            trace = items[-1].split(' ')
-            trace = [hop.split(':') for hop in trace]
-            trace = list(zip(*trace))
-            rtpath, rtts = list(trace[0]), list(trace[1])
-
-            # 1. 替换非法IP
-            rtpath = [h if h != '*' and ipaddress.IPv4Address(h).is_global else '*' for h in rtpath]
-            rtts = [rtts[i] if h != '*' else '*' for i, h in enumerate(rtpath)]
-
-            # 2. 移除末尾的匿名IP
-            for h in range(1, len(rtpath) + 1):
-                if rtpath[len(rtpath) - h] != '*':
-                    break
-            rtpath = rtpath[:len(rtpath) - h + 1]
-            rtts = rtts[:len(rtts) - h + 1]
-
-            # 3. 判断是否正常路径
-            if self.is_valid_trace(rtpath):
-                trace = [rtpath[i] + ':' + rtts[i] for i in range(len(rtpath))]
-                items[-1] = ' '.join(trace)
-                lines[i] = ','.join(items)
-            else:
-                lines[i] = None
-        # 移除异常路径
-        lines = list(filter(None, lines))
+        # 先写临时文件：写出过程被中断时，已登记的_cln文件不会被截断
+        with Util_cache.atomic_filename(self.cln_filename()) as tmp_filename:
+            Util.write_lines((line for line, _, _, _ in chain([first], traces)), tmp_filename)
+        self.cache().put('cln', self.cln_filename())
         print('Generate cleaned trace file \"{0}\"'.format(os.path.abspath(self.cln_filename())))
-        Util.write_list(lines, self.cln_filename())
         return 1
 
-    def extract_trace_data(self):
+    def cache(self):
+        """ 以原始数据文件的指纹为键的缓存 """
+        return Util_cache.FileCache(self.org_filename())
+
+    def link_snapshot_filename(self):
+        return self.org_filename() + '.links.npz'
+
+    def save_link_snapshot(self, link_set):
         """
-        根据traceroute探测得到的数据文件抽取IP链路
+        将extract_trace_data得到的链路数据保存为二进制快照（.npz）
+            每条链路保存：两端地址（uint32），最小间隔，以及该间隔出现的次数
+
+        :param link_set: dict (extract_trace_data的返回值) or LinkAccumulator
+        """
+        if isinstance(link_set, LinkAccumulator):
+            src, dst, gap, count, _ = link_set.arrays()
+            Util_cache.save_arrays(self.link_snapshot_filename(), src=src, dst=dst, gap=gap,
+                                   count=count.astype(np.uint32))
+            self.cache().put('links', self.link_snapshot_filename())
+            return
+        links = list(link_set.items())
+        Util_cache.save_arrays(self.link_snapshot_filename(),
+                               src=np.fromiter((node_address(link[0]) for link, _ in links),
+                                               dtype=np.uint32, count=len(links)),
+                               dst=np.fromiter((node_address(link[1]) for link, _ in links),
+                                               dtype=np.uint32, count=len(links)),
+                               gap=np.fromiter((data[0] for _, data in links),
+                                               dtype=np.uint16, count=len(links)),
+                               count=np.fromiter((data[1] for _, data in links),
+                                                 dtype=np.uint32, count=len(links)))
+        self.cache().put('links', self.link_snapshot_filename())
+
+    def load_link_snapshot(self):
+        """
+        读取二进制链路快照，不必解析任何文本
 
         :return link_set: dict
-            key = (source_node, target_node)
-            value = list of link data, each entry is a tuple: (link_length, link_latency)
-            e.g., {(a1.b1.c1.d1, a2.b2.c2.d2): [(1, 0.11), (1, 0.12), (1, 0.13), ...],
-                   (a2.b2.c2.d2, a3.b3.c3.d3): [(2, 0.21), (2, 0.22), (2, 0.23), ...]}
+            与extract_trace_data的返回值相同；若快照不存在或已失效，返回None
+        """
+        filename = self.cache().get('links')
+        if filename is None:
+            return None
+        arrays = Util_cache.load_arrays(filename)
+        src, dst = arrays['src'].tolist(), arrays['dst'].tolist()
+        if self.intern_table is None:
+            # 同一个IP只生成一个字符串对象
+            names = {}
+            src = [names.get(n) or names.setdefault(n, Util_ip.int_to_ip(n)) for n in src]
+            dst = [names.get(n) or names.setdefault(n, Util_ip.int_to_ip(n)) for n in dst]
+        return dict(zip(zip(src, dst), zip(arrays['gap'].tolist(), arrays['count'].tolist())))
+
+    def iter_valid_traces(self, fused=False, write_cln=False):
         """
+        逐条返回预处理后的路径
+
+        :param fused: boolean
+            只对原始数据文件有效
+            True: 预处理和后续处理在同一遍扫描中完成，不必先写出_cln文件再读回来解析
+            False: 先调用clean_trace_data生成_cln文件（若已存在则直接使用），再从中读取
+        :param write_cln: boolean
+            fused=True时，是否同时写出_cln文件
+
+        :return: generator of (items, rtpath, rtts), 参见parse_trace_line
+        """
+        if self.type == FileType.original and fused:
+            if not write_cln:
+                for _, items, rtpath, rtts in self.iter_cleaned_traces():
+                    if items is not None:
+                        yield items, rtpath, rtts
+                return
+            # 先写临时文件，参见clean_trace_data
+            with Util_cache.atomic_filename(self.cln_filename()) as tmp_filename:
+                with open(tmp_filename, 'w') as cln_file:
+                    for i, (line, items, rtpath, rtts) in enumerate(self.iter_cleaned_traces()):
+                        cln_file.write(line if i == 0 else '\n' + line)
+                        if items is not None:
+                            yield items, rtpath, rtts
+            self.cache().put('cln', self.cln_filename())
+            print('Generate cleaned trace file \"{0}\"'.format(os.path.abspath(self.cln_filename())))
+            return
+
+        if self.type == FileType.binary:
+            for items, rtpath, rtts in self.iter_binary_traces():
+                yield items, rtpath, rtts
+            return
+
         if self.type == FileType.original:
             stat = self.clean_trace_data(lazy=True)
             if stat == -1:
-                return {}
+                return
 
-        lines = Util.read_to_list(self.cln_filename())
-        if not lines:
-            return {}
+        for items, rtpath, rtts in self.iter_traces(self.cln_filename()):
+            yield items, rtpath, rtts
 
-        # 读取文件头部信息
-        pass
+    def iter_binary_traces(self):
+        """
+        从二进制trace文件（参见convert_to_binary）中逐条读取路径，不做任何文本解析
+            若二进制文件未经预处理，则现场调用clean_trace
+            整数模式下，已经预处理过的路径直接返回整数，不再转换为字符串
 
-        # 抽取链路信息
+        :return: generator of (items, rtpath, rtts), 参见parse_trace_line
+            items只包含目标IP和vantage point；rtts中的时延为float，匿名IP对应的时延为*
+        """
+        reader = Util_bintrace.BinaryTraceFile(self.org_filename())
+        int_hops = self.intern_table is not None and reader.cleaned
+        names = {}
+
+        def to_str(n):
+            name = names.get(n)
+            if name is None:
+                name = names[n] = Util_ip.int_to_ip(n)
+            return name
+
+        for dst, vp, _, hops, rtts in reader:
+            if int_hops:
+                rtpath = [Util_bintrace.MARKER_NAMES.get(h, h) for h in hops.tolist()]
+            else:
+                rtpath = [Util_bintrace.MARKER_NAMES.get(h) or to_str(h) for h in hops.tolist()]
+            rtts = ['*' if r != r else r for r in rtts.tolist()]
+            if not reader.cleaned:
+                rtpath, rtts = self.clean_trace(rtpath, rtts)
+                if rtpath is None:
+                    continue
+            yield [to_str(dst), to_str(vp), ''], rtpath, rtts
+
+    def convert_to_binary(self, btrfile=None):
+        """
+        将预处理后的数据转换为二进制trace文件（参见Util_bintrace），之后可以用IpTraceFileV2(btrfile)直接读取
+
+        :param btrfile: string
+            二进制文件名，默认为原始文件名 + '.btr'
+        :return btrfile: string
+        """
+        if btrfile is None:
+            btrfile = self.org_filename() + '.btr'
+        head = list(islice(Util.iter_lines(self.org_filename()), self.head_line_length))
+        with Util_bintrace.BinaryTraceWriter(btrfile, fmt='nmap', head=head, cleaned=True) as writer:
+            intern_table = Util_ip.IpInternTable()
+            for items, rtpath, rtts in self.iter_valid_traces():
+                writer.add_trace(dst=intern_table.intern(items[0]),
+                                 vp=intern_table.intern(items[1]),
+                                 hops=[Util_bintrace.MARKERS[h] if h in Util_bintrace.MARKERS else intern_table.intern(h)
+                                       for h in rtpath],
+                                 rtts=[float('nan') if r == '*' else float(r) for r in rtts])
+        return btrfile
+
+    def extract_trace_data(self, fused=False, write_cln=False, cache=False, rtts=False):
+        """
+        根据traceroute探测得到的数据文件抽取IP链路
+            逐行解析，每条路径的链路立即并入link_set（只保留间隔最小的数据），
+            内存占用只与不同链路的数量有关，与文件大小无关
+
+        :param fused: boolean
+            参见iter_valid_traces
+        :param write_cln: boolean
+            参见iter_valid_traces
+        :param cache: boolean
+            只对原始数据文件有效，且rtts=False
+            True: 若原始文件没有变化，直接读取上次保存的二进制链路快照，跳过所有文本解析；
+                  否则重新抽取链路并保存快照
+        :param rtts: boolean
+            True: 链路数据中包含两端的时延，需要逐条保存
+            False: 只保留每条链路的聚合值（参见LinkAccumulator）
+
+        :return link_set: dict
+            key = (source_node, target_node)
+            rtts=False: value = (最小间隔, 最小间隔出现的次数)
+                e.g., {(a1.b1.c1.d1, a2.b2.c2.d2): (1, 3),
+                       (a2.b2.c2.d2, a3.b3.c3.d3): (2, 1)}
+            rtts=True: value = list of (link_length, rtt_of_source, rtt_of_target)，只保留间隔最小的数据
+                e.g., {(a1.b1.c1.d1, a2.b2.c2.d2): [(1, 0.11, 0.12), (1, 0.12, 0.13), ...]}
+        """
+        if self.type == FileType.original and cache and not rtts:
+            link_set = self.load_link_snapshot()
+            if link_set is None:
+                accumulator = self.extract_link_accumulator(fused=fused, write_cln=write_cln)
+                if os.path.exists(self.org_filename()):
+                    self.save_link_snapshot(accumulator)
+                link_set = accumulator.to_link_set()
+            return link_set
+
+        if not rtts:
+            return self.extract_link_accumulator(fused=fused, write_cln=write_cln).to_link_set()
+
+        # 链路数据中包含时延，只能逐条保存
         link_set = {}
-        for i in range(self.head_line_length, len(lines)):
-            # example:
-            #   117.194.201.244,10.42.0.224,*:* 110.185.170.129:2.85 220.166.252.137:3.45 ...
-            items = lines[i].split(',')
-            # todo: multiple vantage points
-            src = items[1]
-
-            trace = items[-1].split(' ')
-            trace = [hop.split(':') for hop in trace]
-            trace = list(zip(*trace))
-            rtpath, rtts = list(trace[0]), list(trace[1])
-            link2data = self.extract_links(rtpath, rtts=None)
-            for link, data in link2data.items():
-                if link in link_set:
-                    link_set[link].extend(data)
-                else:
-                    link_set[link] = data
-        self.clean_link_data(link_set)
+        for items, rtpath, hop_rtts in self.iter_valid_traces(fused=fused, write_cln=write_cln):
+            if self.intern_table is not None:
+                rtpath = self.intern_table.intern_path(rtpath)
+            self.fold_links(link_set, self.extract_links(rtpath, rtts=hop_rtts))
         return link_set
 
+    def new_link_accumulator(self):
+        """ 节点表示方式与本文件相同的空LinkAccumulator """
+        accumulator = LinkAccumulator(int_nodes=self.intern_table is not None)
+        if self.intern_table is not None:
+            # 与本文件共用驻留表
+            accumulator.intern_table = self.intern_table
+        return accumulator
+
+    def extract_link_accumulator(self, fused=False, write_cln=False):
+        """
+        抽取IP链路，只保留每条链路的聚合值（最小间隔及其次数、观测总数），参见LinkAccumulator
+
+        :param fused: boolean
+            参见iter_valid_traces
+        :param write_cln: boolean
+            参见iter_valid_traces
+        :return accumulator: LinkAccumulator
+        """
+        accumulator = self.new_link_accumulator()
+        for _, rtpath, _ in self.iter_valid_traces(fused=fused, write_cln=write_cln):
+            # 不区分vantage point，分别统计参见extract_vp_link_store
+            accumulator.add_path(rtpath)
+        accumulator.compact()
+        return accumulator
+
+    def extract_node_rtts(self, fused=False, write_cln=False):
+        """
+        收集每个节点（非匿名IP）的全部时延，用于计算时延的cdf（参见RttCdfTable）
+            每个节点的时延保存在array('f')中，每个值只占4字节
+
+        :param fused: boolean
+            参见iter_valid_traces
+        :param write_cln: boolean
+            参见iter_valid_traces
+
+        :return node2rtts: dict
+            key: node
+            value: array.array('f')
+        """
+        node2rtts = {}
+        for _, rtpath, rtts in self.iter_valid_traces(fused=fused, write_cln=write_cln):
+            if self.intern_table is not None:
+                rtpath = self.intern_table.intern_path(rtpath)
+            for h, rtt in zip(rtpath, rtts):
+                if h == '*' or h == '?':
+                    continue
+                data = node2rtts.get(h)
+                if data is None:
+                    data = node2rtts[h] = array('f')
+                data.append(float(rtt))
+        return node2rtts
+
+    def extract_vp_link_store(self, fused=False, write_cln=False):
+        """
+        抽取IP链路，同时记录每条链路被哪些vantage point（每行的第二个字段）观测到
+
+        :param fused: boolean
+            参见iter_valid_traces
+        :param write_cln: boolean
+            参见iter_valid_traces
+        :return store: VpLinkStore
+        """
+        store = VpLinkStore()
+        for items, rtpath, _ in self.iter_valid_traces(fused=fused, write_cln=write_cln):
+            if self.intern_table is not None:
+                rtpath = self.intern_table.intern_path(rtpath)
+            store.add_links(self.extract_links(rtpath), vp=items[1])
+        return store
+
+    def extract_appended_trace_data(self, offset=0):
+        """
+        只处理原始数据文件中从字节偏移>offset<开始新追加的路径（预处理后抽取链路），
+        用于持续测量时的增量更新；offset为0时跳过文件头部
+            文件末尾没有换行符的一行可能还在写入，不做处理，下一次调用从该行的开头重新读取
+
+        :param offset: int
+            上一次调用返回的偏移
+        :return link_set: dict
+            新追加的路径中的链路，参见extract_trace_data
+        :return offset: int
+            本次处理到的位置，作为下一次调用的参数
+        """
+        if not os.path.exists(self.org_filename()):
+            print('The file \"{0}\" does not exist.'.format(self.org_filename()))
+            return {}, offset
+
+        accumulator = self.new_link_accumulator()
+        # 按字节读取，偏移即已处理的字节数
+        with open(self.org_filename(), 'rb') as f:
+            f.seek(offset)
+            if offset == 0:
+                for _ in range(self.head_line_length):
+                    line = f.readline()
+                    if not line.endswith(b'\n'):
+                        # 文件头部还没有写完
+                        return {}, 0
+                    offset += len(line)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # 最后一行还没有写完
+                    break
+                offset += len(line)
+                line = line.decode().rstrip('\n').rstrip('\r').rstrip(' ')
+                if not line:
+                    continue
+                _, rtpath, rtts = self.parse_trace_line(line)
+                rtpath, _ = self.clean_trace(rtpath, rtts)
+                if rtpath is None:
+                    continue
+                accumulator.add_path(rtpath)
+        return accumulator.to_link_set(), offset
+
 
 class IpTraceFileV3(IpTraceFileBase):
     pass
 
 
+class LinkAccumulator(object):
+    """
+    紧凑的链路累加器，代替{link: [(gap,), (gap,), ...]}形式的link_set
+        每次观测只向定长数组追加一个(src, dst, gap)三元组（4 + 4 + 2字节），
+        缓冲区满时用numpy排序、分组，归约为每条链路的聚合值：
+            gap: 最小间隔
+            count: 最小间隔出现的次数（与clean_link_data之后的列表长度相同）
+            total: 全部观测次数
+        内存占用只与不同链路的数量以及缓冲区大小有关，不再为每次观测保存一个tuple
+    """
+    def __init__(self, int_nodes=False, chunk_size=1 << 20):
+        """
+        :param int_nodes: boolean
+            True: to_link_set等输出的节点为整数；False: 输出点分十进制字符串
+            （输入的节点可以是字符串或整数）
+        :param chunk_size: int
+            缓冲区中的观测数达到>chunk_size<时做一次归约
+        """
+        self.int_nodes = int_nodes
+        self.chunk_size = chunk_size
+        self.intern_table = Util_ip.IpInternTable()
+        self.__src = array('I')
+        self.__dst = array('I')
+        self.__gap = array('H')
+        # 已归约的聚合值，按(src, dst)升序
+        self.__keys = np.zeros(0, dtype=np.uint64)
+        self.__min_gap = np.zeros(0, dtype=np.uint16)
+        self.__count = np.zeros(0, dtype=np.int64)
+        self.__total = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        self.compact()
+        return len(self.__keys)
+
+    def add(self, src, dst, gap=1):
+        intern = self.intern_table.intern
+        self.__src.append(src if isinstance(src, int) else intern(src))
+        self.__dst.append(dst if isinstance(dst, int) else intern(dst))
+        self.__gap.append(gap)
+        if len(self.__gap) >= self.chunk_size:
+            self.compact()
+
+    def add_path(self, rtpath):
+        """
+        加入一条路由路径中的全部链路，与extract_links的结果相同，但不构造中间的dict
+
+        :param rtpath: list, 匿名IP为*，未探测的跳为?
+        """
+        intern = self.intern_table.intern
+        src, dst, gap = self.__src, self.__dst, self.__gap
+        prev, prev_i = None, 0
+        for i, h in enumerate(rtpath):
+            if h == '*':
+                continue
+            if h == '?':
+                prev = None
+                continue
+            n = h if isinstance(h, int) else intern(h)
+            if prev is not None:
+                src.append(prev)
+                dst.append(n)
+                gap.append(i - prev_i)
+            prev, prev_i = n, i
+        if len(gap) >= self.chunk_size:
+            self.compact()
+
+    def add_arrays(self, src, dst, gap, count=None, total=None):
+        """
+        直接加入已经归约过的聚合值（比如链路快照或者其他累加器的arrays()），
+        >count<为None时表示每个元素都是一次观测
+        """
+        src = np.asarray(src, dtype=np.uint64)
+        dst = np.asarray(dst, dtype=np.uint64)
+        count = np.ones(len(src), dtype=np.int64) if count is None else np.asarray(count, dtype=np.int64)
+        total = count if total is None else np.asarray(total, dtype=np.int64)
+        self.compact()
+        self.__reduce((src << np.uint64(32)) | dst, np.asarray(gap, dtype=np.uint16), count, total)
+
+    def merge(self, other):
+        """ 将另一个LinkAccumulator合并进来（本对象会被修改） :return self """
+        self.add_arrays(*other.arrays())
+        return self
+
+    def compact(self):
+        """ 把缓冲区中的观测归约到聚合值中 """
+        if not self.__gap:
+            return
+        keys = (np.frombuffer(self.__src, dtype=np.uint32).astype(np.uint64) << np.uint64(32)) | \
+            np.frombuffer(self.__dst, dtype=np.uint32).astype(np.uint64)
+        gap = np.frombuffer(self.__gap, dtype=np.uint16).copy()
+        ones = np.ones(len(gap), dtype=np.int64)
+        self.__src, self.__dst, self.__gap = array('I'), array('I'), array('H')
+        self.__reduce(keys, gap, ones, ones)
+
+    @staticmethod
+    def __reduce_chunk(keys, gap, count, total):
+        """ 只对新的一块排序、归约：返回按key升序、key互不相同的聚合值 """
+        # 按(key, gap)排序，每组的第一个元素即为最小间隔
+        order = np.lexsort((gap, keys))
+        keys, gap, count, total = keys[order], gap[order], count[order], total[order]
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        min_gap = gap[starts]
+        is_min = gap == np.repeat(min_gap, np.diff(np.append(starts, len(keys))))
+        return keys[starts], min_gap, np.add.reduceat(count * is_min, starts), np.add.reduceat(total, starts)
+
+    def __reduce(self, keys, gap, count, total):
+        """
+        把新的一块归约后并入已有的聚合值：已有的链路原地更新，新链路按序插入，
+        不必对已有的聚合值重新排序
+        """
+        if len(keys) == 0:
+            return
+        keys, gap, count, total = self.__reduce_chunk(keys, gap, count, total)
+        if len(self.__keys) == 0:
+            self.__keys, self.__min_gap, self.__count, self.__total = keys, gap, count, total
+            return
+
+        pos = np.searchsorted(self.__keys, keys)
+        found = pos < len(self.__keys)
+        found[found] = self.__keys[pos[found]] == keys[found]
+
+        i = pos[found]
+        known_gap, new_gap, new_count = self.__min_gap[i], gap[found], count[found]
+        self.__count[i] = np.where(new_gap < known_gap, new_count,
+                                   self.__count[i] + np.where(new_gap == known_gap, new_count, 0))
+        self.__min_gap[i] = np.minimum(known_gap, new_gap)
+        self.__total[i] += total[found]
+
+        new = ~found
+        if new.any():
+            pos = pos[new]
+            self.__keys = np.insert(self.__keys, pos, keys[new])
+            self.__min_gap = np.insert(self.__min_gap, pos, gap[new])
+            self.__count = np.insert(self.__count, pos, count[new])
+            self.__total = np.insert(self.__total, pos, total[new])
+
+    def arrays(self):
+        """
+        :return src, dst: numpy.ndarray of uint32
+        :return gap: numpy.ndarray of uint16, 最小间隔
+        :return count: numpy.ndarray of int64, 最小间隔出现的次数
+        :return total: numpy.ndarray of int64, 全部观测次数
+        """
+        self.compact()
+        return ((self.__keys >> np.uint64(32)).astype(np.uint32),
+                (self.__keys & np.uint64(0xFFFFFFFF)).astype(np.uint32),
+                self.__min_gap, self.__count, self.__total)
+
+    def __nodes(self, addresses):
+        addresses = addresses.tolist()
+        if self.int_nodes:
+            return addresses
+        # 同一个IP只生成一个字符串对象
+        names = {}
+        return [names.get(n) or names.setdefault(n, Util_ip.int_to_ip(n)) for n in addresses]
+
+    def links(self):
+        """ :return: list of (source_node, target_node) """
+        src, dst, _, _, _ = self.arrays()
+        return list(zip(self.__nodes(src), self.__nodes(dst)))
+
+    def to_link_set(self):
+        """
+        :return link_set: dict
+            key = (source_node, target_node)
+            value = (最小间隔, 最小间隔出现的次数)，参见extract_trace_data
+        """
+        src, dst, gap, count, _ = self.arrays()
+        return dict(zip(zip(self.__nodes(src), self.__nodes(dst)), zip(gap.tolist(), count.tolist())))
+
+
+class VpLinkStore(object):
+    """
+    按vantage point（VP）记录链路
+        每个VP对应一个比特位，每条链路的VP集合用一个整数（bitset）表示，比Python set紧凑得多；
+        每条链路另外记录所有VP中观测到的最小间隔，VP集合只包含以最小间隔观测到该链路的VP
+        （与fold_links的语义相同：出现更小的间隔时重新开始记录）
+    不同VP（或不同文件）的结果可以直接合并（参见merge），也可以保存为.npz文件（参见save/load），
+    在其他机器上合并时不必重新解析trace文件
+    """
+    def __init__(self):
+        self.vps = []
+        self.vp_index = {}
+        self.link2vps = {}
+        self.link2gap = {}
+
+    def __len__(self):
+        return len(self.link2vps)
+
+    def vp_bit(self, vp):
+        """ 返回>vp<对应的比特位，新的VP自动分配下一位 """
+        bit = self.vp_index.get(vp)
+        if bit is None:
+            bit = self.vp_index[vp] = len(self.vps)
+            self.vps.append(vp)
+        return bit
+
+    def __update(self, link, mask, gap):
+        """ >mask<中的VP以间隔>gap<观测到了>link< """
+        known = self.link2gap.get(link)
+        if known is None or gap < known:
+            self.link2gap[link] = gap
+            self.link2vps[link] = mask
+        elif gap == known:
+            self.link2vps[link] |= mask
+
+    def add(self, link, vp, gap=1):
+        self.add_links({link: [(gap,)]}, vp)
+
+    def add_links(self, link2data, vp):
+        """
+        :param link2data: dict, extract_links的返回值
+        :param vp: string, vantage point
+        """
+        mask = 1 << self.vp_bit(vp)
+        for link, data in link2data.items():
+            self.__update(link, mask, min(data)[0])
+
+    def merge(self, other):
+        """
+        将另一个VpLinkStore合并进来（本对象会被修改）
+            若>other<的VP顺序与本对象一致（比如本对象是由>other<扩展而来），直接按位或；
+            否则先把>other<的比特位映射到本对象的比特位
+        :return self
+        """
+        bits = [self.vp_bit(vp) for vp in other.vps]
+        identity = all(i == bit for i, bit in enumerate(bits))
+        for link, mask in other.link2vps.items():
+            if not identity:
+                remapped, i = 0, 0
+                while mask:
+                    if mask & 1:
+                        remapped |= 1 << bits[i]
+                    mask >>= 1
+                    i += 1
+                mask = remapped
+            self.__update(link, mask, other.link2gap[link])
+        return self
+
+    def vps_of(self, link):
+        """ 观测到>link<的全部VP """
+        mask = self.link2vps.get(link, 0)
+        return [vp for i, vp in enumerate(self.vps) if mask >> i & 1]
+
+    def num_vps(self, link):
+        return bin(self.link2vps.get(link, 0)).count('1')
+
+    def links_of(self, vp):
+        """ >vp<观测到的全部链路 """
+        bit = self.vp_index.get(vp)
+        if bit is None:
+            return []
+        return [link for link, mask in self.link2vps.items() if mask >> bit & 1]
+
+    def to_link_set(self):
+        """
+        :return link_set: dict
+            不区分VP的链路数据，格式与extract_trace_data相同：
+            (最小间隔, 以最小间隔观测到该链路的VP数量)
+        """
+        return {link: (self.link2gap[link], self.num_vps(link)) for link in self.link2vps}
+
+    def save(self, filename):
+        """ 保存为.npz文件：链路两端地址为uint32，VP集合为每条链路定长的字节串 """
+        links = list(self.link2vps.items())
+        width = max(1, (len(self.vps) + 7) // 8)
+        masks = np.frombuffer(b''.join(mask.to_bytes(width, 'little') for _, mask in links), dtype=np.uint8)
+        Util_cache.save_arrays(filename,
+                               vps=np.array(self.vps, dtype=str),
+                               src=np.fromiter((node_address(link[0]) for link, _ in links),
+                                               dtype=np.uint32, count=len(links)),
+                               dst=np.fromiter((node_address(link[1]) for link, _ in links),
+                                               dtype=np.uint32, count=len(links)),
+                               gap=np.fromiter((self.link2gap[link] for link, _ in links),
+                                               dtype=np.uint16, count=len(links)),
+                               masks=masks.reshape(len(links), width))
+
+    @staticmethod
+    def load(filename, int_nodes=False):
+        """
+        :param int_nodes: boolean
+            True: 节点用整数表示；False: 节点用点分十进制字符串表示
+        :return store: VpLinkStore
+        """
+        arrays = Util_cache.load_arrays(filename)
+        store = VpLinkStore()
+        for vp in arrays['vps'].tolist():
+            store.vp_bit(vp)
+        src, dst = arrays['src'].tolist(), arrays['dst'].tolist()
+        if not int_nodes:
+            src = [Util_ip.int_to_ip(n) for n in src]
+            dst = [Util_ip.int_to_ip(n) for n in dst]
+        masks = [int.from_bytes(row.tobytes(), 'little') for row in arrays['masks']]
+        for link, mask, gap in zip(zip(src, dst), masks, arrays['gap'].tolist()):
+            store.link2vps[link] = mask
+            store.link2gap[link] = gap
+        return store
+
+
 class IpTopo(networkx.DiGraph):
-    def __init__(self, incoming_graph_data=None, **attr):
+    """
+    IP拓扑图，节点有两种表示方式：
+        字符串模式（默认）：IP节点为'10.0.1.1'，IP block节点为'10.0.1.0/24'
+        整数模式（int_nodes=True）：IP节点为uint32整数，IP block节点为(网络地址, 前缀长度)，
+            前缀距离和block的计算直接在整数上进行，节省内存和解析时间
+    """
+    def __init__(self, incoming_graph_data=None, int_nodes=False, **attr):
         networkx.DiGraph.__init__(self, incoming_graph_data, **attr)
+        # 保存在图属性中，copy/deepcopy之后仍然有效
+        self.graph['int_nodes'] = self.graph.get('int_nodes', False) or int_nodes
+
+    @property
+    def int_nodes(self):
+        return self.graph.get('int_nodes', False)
+
+    def ip_block(self, ip, prefix_length):
+        """ 根据IP节点>ip<生成IP block节点 """
+        if self.int_nodes:
+            return get_ip_block_int(node_address(ip), prefix_length)
+        return get_ip_block(ip, prefix_length)
 
     def info(self):
         info = networkx.info(self)
@@ -329,15 +1224,61 @@ class IpTopo(networkx.DiGraph):
 
         return info
 
-    def update_prefix_distance(self):
+    def update_prefix_distance(self, vectorized=True):
+        """
+        计算每条边两端节点的前缀距离，保存为边属性'prefix_distance'
+
+        :param vectorized: boolean
+            True: 把所有边的两端地址放入两个uint32数组，一次性计算，再批量写回
+            False: 逐条边计算
+        """
+        if vectorized:
+            self.update_prefix_distance_vectorized()
+            return
+
         distances = dict.fromkeys(self.edges(), 0.0)
+        addresses = {n: node_address(n) for n in self.nodes}
         for e in self.edges:
             # 可同时兼容节点为子网或者单个IP的情况
-            first = ipaddress.IPv4Network(e[0]).network_address
-            second = ipaddress.IPv4Network(e[1]).network_address
-            distances[e] = prefix_distance(first, second)
+            distances[e] = prefix_distance(addresses[e[0]], addresses[e[1]])
         networkx.set_edge_attributes(self, distances, 'prefix_distance')
 
+    def add_links(self, links):
+        """
+        增量加入链路，只为新加入的边计算前缀距离
+
+        :param links: iterable of (source_node, target_node)，只遍历一次，可以是生成器
+        :return new_edges: list
+            原图中不存在的边
+        """
+        new_edges = list(set(e for e in links if not self.has_edge(*e)))
+        if not new_edges:
+            return new_edges
+        self.add_edges_from(new_edges)
+        first = np.fromiter((node_address(u) for u, _ in new_edges), dtype=np.uint32, count=len(new_edges))
+        second = np.fromiter((node_address(v) for _, v in new_edges), dtype=np.uint32, count=len(new_edges))
+        for (u, v), d in zip(new_edges, prefix_distance_array(first, second).tolist()):
+            self.succ[u][v]['prefix_distance'] = d
+        return new_edges
+
+    def update_prefix_distance_vectorized(self):
+        if self.number_of_edges() == 0:
+            return
+        # 每个节点只解析一次地址
+        index = {}
+        addresses = np.empty(self.number_of_nodes(), dtype=np.uint32)
+        for i, n in enumerate(self.nodes):
+            index[n] = i
+            addresses[i] = node_address(n)
+
+        edges = list(self.edges)
+        first = np.fromiter((index[u] for u, _ in edges), dtype=np.int64, count=len(edges))
+        second = np.fromiter((index[v] for _, v in edges), dtype=np.int64, count=len(edges))
+        distances = prefix_distance_array(addresses[first], addresses[second]).tolist()
+
+        for (u, v), d in zip(edges, distances):
+            self.succ[u][v]['prefix_distance'] = d
+
     def get_clique_1(self, n, th):
         nodes_in_clique = [n]
         max_prefix_dist = 0
@@ -369,49 +1310,369 @@ class IpTopo(networkx.DiGraph):
             pos += 1
         return nodes_in_clique, max_prefix_dist
 
+    def threshold_components(self, th):
+        """
+        一次性求出所有“阈值连通”的节点簇：只保留prefix_distance <= th的边（忽略方向），
+        每个连通分量就是一个簇；用并查集扫描一遍所有边，复杂度O(E alpha(V))
+            对每个节点n，get_clique_1(n, th)得到的节点集合就是n所在的簇
+
+        :param th: int
+            前缀距离阈值
+        :return clusters: list of (nodes_in_clique, max_prefix_dist)
+            max_prefix_dist是簇内所有满足阈值的边的最大前缀距离，孤立节点为0
+        """
+        ds = Util_graph.DisjointSet(self.nodes)
+        edges = [(u, v, d) for u, v, d in self.edges(data='prefix_distance') if d is not None and d <= th]
+        for u, v, _ in edges:
+            ds.union(u, v)
+
+        max_prefix_dist = {}
+        for u, _, d in edges:
+            root = ds.find(u)
+            if d > max_prefix_dist.get(root, 0):
+                max_prefix_dist[root] = d
+        return [(nodes, max_prefix_dist.get(root, 0)) for root, nodes in ds.groups().items()]
+
     def pop_one_clique(self, node_list, th):
         # pick a node at random
         n = node_list[0]
         nodes_in_clique = [n]
         max_prefix_dist = 0
+        first = node_address(n)
         for m in node_list[1:]:
-            d = prefix_distance(ipaddress.IPv4Address(n), ipaddress.IPv4Address(m))
+            d = prefix_distance(first, node_address(m))
             if d <= th:
                 nodes_in_clique.append(m)
                 max_prefix_dist = max(max_prefix_dist, d)
         return nodes_in_clique, max_prefix_dist
 
+    def cluster_nodes(self, th):
+        """
+        将图中所有节点按前缀距离阈值>th<聚类，参见prefix_clusters
+        """
+        return prefix_clusters(self.nodes, th)
+
+    def shortest_cycle_through(self, n, max_length, nodes=None):
+        """
+        广度优先搜索经过节点>n<的最短环
+
+        :param n: 起点
+        :param max_length: int
+            环的最大长度（边数），超过该长度的环不予考虑
+        :param nodes: set
+            若不为None，只在这些节点中搜索（比如n所在的强连通分量）
+        :return cycle: list
+            环上的节点，从n开始；不存在长度不超过>max_length<的环时，返回None
+        """
+        if self.has_edge(n, n):
+            return [n]
+        parent = {n: None}
+        queue = deque([(n, 0)])
+        while queue:
+            u, depth = queue.popleft()
+            if depth >= max_length:
+                continue
+            for v in self.succ[u]:
+                if v == n and depth > 0:
+                    cycle = [u]
+                    while parent[cycle[-1]] is not None:
+                        cycle.append(parent[cycle[-1]])
+                    return cycle[::-1]
+                if v in parent or (nodes is not None and v not in nodes):
+                    continue
+                parent[v] = u
+                queue.append((v, depth + 1))
+        return None
+
+    def cycle_summary(self, max_length=8, max_cycles=10, max_seeds=None):
+        """
+        环路诊断：先用线性时间求出全部强连通分量（只有分量内部才可能存在环），
+        再在每个非平凡分量中找出有限个较短的环作为例证，代替networkx.simple_cycles的穷举
+        （后者在最坏情况下是指数复杂度）
+
+        :param max_length: int
+            例证环的最大长度（边数）
+        :param max_cycles: int
+            每个分量最多给出的例证环数量
+        :param max_seeds: int
+            每个分量最多以多少个节点为起点搜索例证环，默认为4 * max_cycles；
+            每次搜索的代价不超过该分量的边数
+        :return summaries: list of dict, 按分量大小降序排列
+            'nodes': list, 分量中的节点
+            'num_nodes': int, 节点数
+            'num_edges': int, 分量内部的边数
+            'cycles': list of lists, 例证环，每个环都从其中一个节点出发
+        """
+        if max_seeds is None:
+            max_seeds = 4 * max_cycles
+
+        summaries = []
+        for scc in networkx.strongly_connected_components(self):
+            if len(scc) == 1:
+                n = next(iter(scc))
+                if not self.has_edge(n, n):
+                    continue
+            num_edges = sum(1 for u in scc for v in self.succ[u] if v in scc)
+
+            cycles, known = [], set()
+            for i, n in enumerate(scc):
+                if i >= max_seeds or len(cycles) >= max_cycles:
+                    break
+                cycle = self.shortest_cycle_through(n, max_length, nodes=scc)
+                if cycle is None:
+                    continue
+                # 同一个环从不同节点出发只记录一次
+                k = cycle.index(min(cycle, key=node_address))
+                key = tuple(cycle[k:] + cycle[:k])
+                if key not in known:
+                    known.add(key)
+                    cycles.append(cycle)
+
+            summaries.append({'nodes': list(scc),
+                              'num_nodes': len(scc),
+                              'num_edges': num_edges,
+                              'cycles': cycles})
+        summaries.sort(key=lambda x: x['num_nodes'], reverse=True)
+        return summaries
+
+    def prefix_dendrogram(self):
+        """ 图中所有节点的前缀聚类层次树，参见PrefixDendrogram """
+        return PrefixDendrogram(self.nodes)
+
+    def block_topo(self, th, dendrogram=None, **attr):
+        """
+        生成阈值为>th<的IP block拓扑（商图），与generate_block_topo的结果相同，但不修改原图
+
+        :param th: int
+            前缀距离阈值
+        :param dendrogram: PrefixDendrogram
+            若为None，则现场计算；对多个阈值计算时，应当复用同一个dendrogram
+        :param attr: 新图的属性，比如name
+        :return block_graph: IpTopo
+        """
+        if dendrogram is None:
+            dendrogram = self.prefix_dendrogram()
+        return self.contract(self.block_mapping(dendrogram.clusters(th)), **attr)
+
+    def block_mapping(self, clusters):
+        """
+        :param clusters: list of (nodes_in_clique, max_prefix_dist), 参见prefix_clusters
+        :return node2block: dict
+            key: 节点
+            value: 所属的IP block节点，以类中第一个节点和类内最大前缀距离命名
+        """
+        node2block = {}
+        for nodes_in_clique, max_prefix_dist in clusters:
+            ipb_node = self.ip_block(ip=nodes_in_clique[0], prefix_length=32 - max_prefix_dist)
+            for n in nodes_in_clique:
+                node2block[n] = ipb_node
+        return node2block
+
+    def contract(self, node2block, block_graph=None, **attr):
+        """
+        按节点到block的映射生成商图
+            一次批量处理所有边：边的两端换成block编号，去掉block内部的边，
+            用整数键去重，再用block的整数地址批量计算前缀距离；
+            每个节点、每条边只访问一次，不必逐个block地修改图
+
+        :param node2block: dict
+            key: 图中的每个节点（必须完整）
+            value: 所属的block节点
+        :param block_graph: IpTopo
+            结果写入该图；若为None，则新建一个IpTopo（不修改原图）；
+            若为原图本身，则原图的节点和边先被清空（图的属性保持不变）
+        :param attr: 新图的属性，比如name
+        :return block_graph: IpTopo
+            block节点的属性：num_active_ips, active_ips（按>node2block<中的顺序）
+        """
+        block_index, members = {}, []
+        node2index = {}
+        for n, b in node2block.items():
+            i = block_index.get(b)
+            if i is None:
+                i = block_index[b] = len(members)
+                members.append([])
+            members[i].append(n)
+            node2index[n] = i
+        blocks = list(block_index)
+
+        edges = []
+        num_edges = self.number_of_edges()
+        if num_edges > 0:
+            # 每条边的两端依次排列：[u0, v0, u1, v1, ...]
+            ends = np.fromiter((node2index[n] for e in self.edges for n in e), dtype=np.int64, count=2 * num_edges)
+            first, second = ends[0::2], ends[1::2]
+            keys = np.unique((first * len(blocks) + second)[first != second])
+            first, second = keys // len(blocks), keys % len(blocks)
+            addresses = np.fromiter((node_address(b) for b in blocks), dtype=np.uint32, count=len(blocks))
+            edges = zip(first.tolist(), second.tolist(),
+                        prefix_distance_array(addresses[first], addresses[second]).tolist())
+
+        if block_graph is None:
+            block_graph = IpTopo(int_nodes=self.int_nodes, **attr)
+        elif block_graph is self:
+            graph_attr = dict(self.graph)
+            self.clear()
+            self.graph.update(graph_attr, **attr)
+        block_graph.add_nodes_from((b, {'num_active_ips': len(nodes), 'active_ips': nodes})
+                                   for b, nodes in zip(blocks, members))
+        block_graph.add_edges_from((blocks[i], blocks[j], {'prefix_distance': d}) for i, j, d in edges)
+        return block_graph
+
+    def sweep_block_topo(self, th_candidates):
+        """
+        对多个阈值生成IP block拓扑：前缀聚类只计算一次，也不必deepcopy原图
+
+        :param th_candidates: iterable of int
+        :return: generator of (th, block_graph)
+        """
+        dendrogram = self.prefix_dendrogram()
+        for th in th_candidates:
+            yield th, self.block_topo(th, dendrogram=dendrogram, name='ipb-topo_th-' + str(th))
+
     def generate_block_topo(self, th):
-        node_list = list(self.nodes)
-        while len(node_list) > 0:
+        """
+        将原图就地替换为阈值为>th<的IP block拓扑（图的属性保持不变），参见block_topo
+        """
+        # 一次性求出所有th-clique，代替反复调用pop_one_clique；再整体收缩，代替逐个block地改图
+        self.contract(self.block_mapping(self.cluster_nodes(th)), block_graph=self)
 
-            # find the th-clique that contains n
-            nodes_in_clique, max_prefix_dist = self.pop_one_clique(node_list, th)
 
-            # create ip block node
-            ipb_node = get_ip_block(ip=nodes_in_clique[0], prefix_length=32 - max_prefix_dist)
-            self.add_node(ipb_node, num_active_ips=len(nodes_in_clique), active_ips=nodes_in_clique)
+class IncrementalBlockTopo(object):
+    """
+    随着新链路的加入，增量维护IP拓扑>ip_graph<在阈值>th<下的IP block拓扑（参见IpTopo.block_topo）
+        节点n所属的block由地址右移th位后的值（key）唯一确定，且不会随新节点的加入而改变，
+        所以每次只需更新新节点所在的block以及新边两端的block，不必重新聚类
+    """
+    def __init__(self, ip_graph, th):
+        self.ip_graph = ip_graph
+        self.th = th
+        self.block_graph = ip_graph.block_topo(th, name='ipb-topo_th-' + str(th))
+        # key -> 当前的block节点
+        self.key2block = {node_address(b) >> th: b for b in self.block_graph}
+
+    def block_of(self, n):
+        """ 节点>n<所属的block节点 """
+        return self.key2block[node_address(n) >> self.th]
+
+    def add_links(self, links):
+        """
+        加入新链路，并局部更新block拓扑
 
-            # connect neighbors of original ip nodes to the block node
-            preds, succs = set(), set()
-            for n in nodes_in_clique:
-                preds = preds.union(set(self.pred[n]).difference(nodes_in_clique))
-                succs = succs.union(set(self.succ[n]).difference(nodes_in_clique))
+        :param links: iterable of (source_node, target_node)
+        :return touched: set
+            新建、扩大或者新增了边的block节点
+        """
+        g, bg = self.ip_graph, self.block_graph
+        # 下面要遍历两次，>links<可能是生成器
+        links = list(links)
+        new_nodes = set(n for link in links for n in link if n not in g)
+        new_edges = g.add_links(links)
+
+        touched = set()
+        for n in new_nodes:
+            touched.add(self.__add_node(n))
+
+        edges_to_add = []
+        for u, v in new_edges:
+            bu, bv = self.block_of(u), self.block_of(v)
+            if bu != bv and not bg.has_edge(bu, bv):
+                edges_to_add.append((bu, bv, {'prefix_distance': prefix_distance(node_address(bu),
+                                                                                 node_address(bv))}))
+                touched.update((bu, bv))
+        bg.add_edges_from(edges_to_add)
+        return touched
+
+    def __add_node(self, n):
+        g, bg = self.ip_graph, self.block_graph
+        address = node_address(n)
+        key = address >> self.th
+        ipb_node = self.key2block.get(key)
+        if ipb_node is None:
+            ipb_node = g.ip_block(ip=n, prefix_length=32)
+            bg.add_node(ipb_node, num_active_ips=1, active_ips=[n])
+            self.key2block[key] = ipb_node
+            return ipb_node
+
+        attrs = bg.nodes[ipb_node]
+        attrs['active_ips'].append(n)
+        attrs['num_active_ips'] += 1
+
+        # 新节点与block网络地址的前缀距离若超出原来的范围，block需要扩大（重新命名）
+        max_prefix_dist = max(32 - node_prefix_length(ipb_node),
+                              prefix_distance(node_address(ipb_node), address))
+        new_ipb_node = g.ip_block(ip=attrs['active_ips'][0], prefix_length=32 - max_prefix_dist)
+        if new_ipb_node != ipb_node:
+            networkx.relabel_nodes(bg, {ipb_node: new_ipb_node}, copy=False)
+            self.key2block[key] = new_ipb_node
+            new_address = node_address(new_ipb_node)
+            for nbr, data in bg.pred[new_ipb_node].items():
+                data['prefix_distance'] = prefix_distance(node_address(nbr), new_address)
+            for nbr, data in bg.succ[new_ipb_node].items():
+                data['prefix_distance'] = prefix_distance(new_address, node_address(nbr))
+        return new_ipb_node
+
+
+def extract_trace_file(filename, int_nodes=False, fused=False):
+    """
+    预处理单个trace文件并抽取IP链路，供进程池调用（必须是模块级函数才能被pickle）
 
-            edges_to_add = []
-            for n in preds:
-                d = prefix_distance(ipaddress.IPv4Network(n).network_address,
-                                    ipaddress.IPv4Network(ipb_node).network_address)
-                edges_to_add.append((n, ipb_node, {'prefix_distance': d}))
-            for n in succs:
-                d = prefix_distance(ipaddress.IPv4Network(n).network_address,
-                                    ipaddress.IPv4Network(ipb_node).network_address)
-                edges_to_add.append((ipb_node, n, {'prefix_distance': d}))
+    :return link_set: dict
+        参见IpTraceFileV2.extract_trace_data
+    """
+    return IpTraceFileV2(filename, int_nodes=int_nodes).extract_trace_data(fused=fused)
+
+
+def merge_link_sets(link_sets, merged=None):
+    """
+    合并多个文件的链路数据，保持clean_link_data的语义：每条链路只保留间隔最小的数据（及其次数）
+
+    :param link_sets: iterable of dict
+        每个元素都是extract_trace_data(rtts=False)的返回值
+    :param merged: dict
+        若不为None，则合并到该dict中（会被修改）
+    :return merged: dict
+    """
+    merged = {} if merged is None else merged
+    for link_set in link_sets:
+        IpTraceFileBase.fold_link_counts(merged, link_set)
+    return merged
 
-            self.add_edges_from(edges_to_add)
-            self.remove_nodes_from(nodes_in_clique)
 
-            node_list = list(set(node_list).difference(set(nodes_in_clique)))
+def extract_trace_files(filenames, processes=None, int_nodes=False, fused=False):
+    """
+    用进程池并行处理多个trace文件：每个文件的预处理和链路抽取在一个子进程中完成，
+    主进程按完成顺序合并各文件的链路数据
+
+    :param filenames: list of strings
+    :param processes: int
+        进程数，None表示使用全部CPU核；1表示在当前进程中串行处理
+    :param int_nodes: boolean
+        参见IpTraceFileV2
+    :param fused: boolean
+        参见IpTraceFileV2.extract_trace_data
+    :return link_set: dict
+    """
+    worker = partial(extract_trace_file, int_nodes=int_nodes, fused=fused)
+    if processes == 1 or len(filenames) <= 1:
+        return merge_link_sets(map(worker, filenames))
+
+    with multiprocessing.Pool(processes) as pool:
+        return merge_link_sets(pool.imap_unordered(worker, filenames))
+
+
+def build_ip_topo(filenames, processes=None, int_nodes=False, fused=False, **attr):
+    """
+    并行处理多个trace文件，并将所有链路合并到一个IpTopo中
+
+    :return ip_graph: IpTopo
+        已经计算好边属性'prefix_distance'
+    """
+    link_set = extract_trace_files(filenames, processes=processes, int_nodes=int_nodes, fused=fused)
+    ip_graph = IpTopo(int_nodes=int_nodes, **attr)
+    ip_graph.add_edges_from(link_set.keys())
+    ip_graph.update_prefix_distance()
+    return ip_graph
 
 
 if "__main__" == __name__:
@@ -427,12 +1688,11 @@ if "__main__" == __name__:
     print(ip_graph.info())
 
     th_candidates = [20]
-    for th in th_candidates:
+    for th, ip_block_graph in ip_graph.sweep_block_topo(th_candidates):
         print('####prefix threshold = ' + str(th))
-        ip_block_graph = copy.deepcopy(ip_graph)
-        ip_block_graph.name = 'ipb-topo_th-' + str(th)
-        ip_block_graph.generate_block_topo(th)
         print(ip_block_graph.info())
 
-        for cc in networkx.simple_cycles(ip_block_graph):
-            print(cc)
+        for scc in ip_block_graph.cycle_summary(max_length=8, max_cycles=10):
+            print('SCC: {0} nodes, {1} edges'.format(scc['num_nodes'], scc['num_edges']))
+            for cc in scc['cycles']:
+                print('\t', [node_to_str(n) for n in cc])
@@ -0,0 +1,747 @@
+#! python
+# -*- coding:utf-8 -*-
+"""
+并发的批量探测引擎
+    traceroutefast每次只探测一个目标，并且要等待超时才能开始下一个目标；
+    本引擎同时保持成千上万个目标处于探测中，所有目标的各个TTL的探测包在同一个发送流中发出，
+    响应报文通过探测包中的编号（probe id）匹配回对应的目标和TTL，发送速率只受pps预算的限制
+
+    后端（backend）负责收发报文，需要实现：
+        send(probes): 发送一批探测包，probes为Probe的列表
+        receive(timeout): 等待至多>timeout<秒，返回已经收到的Reply列表
+        close()
+    SimulatedNetwork是一个模拟网络，不需要发送任何报文，便于离线测试；
+    ScapyBackend用scapy收发真实的ICMP报文（只有用到时才导入scapy）
+
+    每个目标的探测过程由一个策略对象（状态机）控制，参见TraceStrategy
+
+example:
+    engine = ProbeEngine(SimulatedNetwork(seed=1), pps=10000)
+    for strategy in engine.run(TraceStrategy(dst, ttl=range(1, 26)) for dst in hosts):
+        print(strategy.dst, strategy.rtpath())
+"""
+
+import time
+import heapq
+import select
+from collections import deque, namedtuple
+
+# 探测包：编号（32位，ICMP id为高16位，ICMP seq为低16位），目标IP，TTL
+Probe = namedtuple('Probe', ['probe_id', 'dst', 'ttl'])
+# 响应报文：对应的探测包编号，响应报文的源IP，是否抵达目标（参见traceroute.dst_reached）
+Reply = namedtuple('Reply', ['probe_id', 'src', 'reached'])
+
+PROBE_ID_MASK = 0xFFFFFFFF
+# rtpath中没有发出探测包的TTL，与匿名路由器（*）不同：该跳的两侧不能连成链路
+UNPROBED = '?'
+
+
+class TokenBucket(object):
+    """
+    令牌桶：平均速率为>rate<个/秒，允许的突发量为>burst<个
+    """
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        """
+        :param rate: float
+            每秒产生的令牌数，None表示不限速
+        :param burst: float
+            桶的容量，默认为10ms的令牌数（至少为1）
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate / 100.0 if rate else 1.0)
+        self.clock = clock
+        self.tokens = self.burst
+        self.last = clock()
+
+    def __refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self, n):
+        """ 取出至多>n<个令牌，返回实际取出的个数 """
+        if self.rate is None:
+            return n
+        self.__refill()
+        k = min(n, int(self.tokens))
+        self.tokens -= k
+        return k
+
+    def delay(self):
+        """ 距离下一个令牌可用的时间（秒） """
+        if self.rate is None:
+            return 0.0
+        self.__refill()
+        return max(0.0, (1.0 - self.tokens) / self.rate)
+
+
+class TraceStrategy(object):
+    """
+    单个目标的探测策略，与traceroutefast相同：一次发出全部TTL的探测包
+
+    引擎按以下方式驱动策略（状态机）：
+        start(): 返回最先需要探测的TTL列表；返回None表示暂不开始，
+                 引擎在同组（参见group）的其他目标探测结束后再次调用start()
+        on_reply(ttl, src, reached, rtt): 收到TTL为>ttl<的探测包的响应，返回接下来需要探测的TTL列表
+        on_timeout(ttl): TTL为>ttl<的探测包超时，返回接下来需要探测的TTL列表
+    当某个目标没有未完成的探测包，且最近一次回调没有返回新的TTL时，该目标的探测结束
+    子类只需重写这三个方法即可实现其他策略
+    """
+    def __init__(self, dst, ttl=range(1, 31)):
+        self.dst = str(dst)
+        self.ttl = list(ttl)
+        # ttl -> (src, reached, rtt)
+        self.hops = {}
+
+    def start(self):
+        return list(self.ttl)
+
+    def group(self):
+        """ :return: hashable, 推迟开始的目标所在的组 """
+        return self.dst
+
+    def on_reply(self, ttl, src, reached, rtt):
+        self.hops[ttl] = (src, reached, rtt)
+        return []
+
+    def on_timeout(self, ttl):
+        return []
+
+    def was_probed(self, ttl):
+        """ :return: boolean, 是否发出过TTL为>ttl<的探测包 """
+        return True
+
+    def rtpath(self):
+        """
+        :return rtpath: list of tuples, 与traceroutefast的返回值格式相同
+            (ttl, ip)，匿名路由器为(ttl, '*')，抵达目标的一跳为(ttl, ip, 'EOP')，其后的跳被去掉；
+            策略跳过、没有探测的TTL为(ttl, UNPROBED)
+        """
+        rtpath = []
+        for t in self.ttl:
+            hop = self.hops.get(t)
+            if hop is None:
+                rtpath.append((t, '*' if self.was_probed(t) else UNPROBED))
+            elif hop[1]:
+                rtpath.append((t, hop[0], 'EOP'))
+                break
+            else:
+                rtpath.append((t, hop[0]))
+        return rtpath
+
+
+class StopSets(object):
+    """
+    Doubletree的停止集合，由同一个vantage point探测的所有目标共用
+        local: 反向探测（从起始TTL向vantage point方向）中见到的接口，
+               再次见到时说明更靠近vantage point的路径已经探测过，反向探测停止
+        global: (接口, 目标所在的前缀) -> 从该接口到目标还有几跳（未知为None），
+                正向探测中见到已记录的二元组时，说明此后到该前缀的路径已经探测过
+    停止集合为空时同时开始的目标得不到任何节省，所以前>seed_traces<个目标按慢启动的方式开始：
+    同时探测的目标数不超过已经结束的目标数 + 1，即停止集合每多一批路径，并发数翻一倍，
+    直到达到引擎的window（seed_traces默认与ProbeEngine的window相同，为0时不做限制）
+    """
+    def __init__(self, prefix_length=24, seed_traces=4096):
+        self.prefix_length = prefix_length
+        self.seed_traces = seed_traces
+        self.local = set()
+        self.global_ = {}
+        self.num_active = 0
+        self.num_finished = 0
+
+    def prefix_key(self, dst):
+        return _ip_to_int(dst) >> (32 - self.prefix_length)
+
+    def in_local(self, iface):
+        return iface in self.local
+
+    def add_local(self, iface):
+        self.local.add(iface)
+
+    def lookup_global(self, iface, dst):
+        """
+        :return hit: boolean
+        :return remaining: int or None, 从>iface<到目标的跳数
+        """
+        key = (iface, self.prefix_key(dst))
+        return key in self.global_, self.global_.get(key)
+
+    def add_global(self, iface, dst, remaining=None):
+        key = (iface, self.prefix_key(dst))
+        if self.global_.get(key) is None:
+            self.global_[key] = remaining
+
+    def start_trace(self):
+        """ :return: boolean, False表示停止集合还在播种，应等待正在探测的目标 """
+        if self.num_finished < self.seed_traces and self.num_active > self.num_finished:
+            return False
+        self.num_active += 1
+        return True
+
+    def end_trace(self):
+        self.num_active -= 1
+        self.num_finished += 1
+
+
+class DoubletreeStrategy(TraceStrategy):
+    """
+    Doubletree探测策略：从中间的TTL（>start_ttl<）开始，先正向、再反向逐跳探测
+        正向：直到抵达目标，或者连续>gap_limit<个TTL没有响应，或者遇到global停止集合中的
+              (接口, 目标前缀)；此时若已知从该接口到目标的跳数，则跳到目标前>tail_hops<跳继续正向探测
+              （不再检查停止集合），以保留每个目标自己的最后几条链路
+        反向：直到遇到local停止集合中的接口，或者到达最小TTL
+    跳过的TTL在rtpath中为UNPROBED（?），而不是匿名（*）：跳到目标前的最后几跳时，
+    两侧的接口之间隔着没有探测的路径，不能当作间隔若干跳的链路
+    停止集合还在播种时（参见StopSets），新的目标推迟开始
+    """
+    def __init__(self, dst, ttl=range(1, 31), stop_sets=None, start_ttl=None, gap_limit=3, tail_hops=1):
+        TraceStrategy.__init__(self, dst, ttl=ttl)
+        self.stop_sets = stop_sets if stop_sets is not None else StopSets()
+        self.min_ttl, self.max_ttl = min(self.ttl), max(self.ttl)
+        self.start_ttl = start_ttl if start_ttl is not None else self.min_ttl + len(self.ttl) // 2
+        self.start_ttl = min(max(self.start_ttl, self.min_ttl), self.max_ttl)
+        self.gap_limit = gap_limit
+        self.tail_hops = tail_hops
+        self.phase = 'forward'
+        self.gap = 0
+        self.reached_ttl = None
+        self.timeouts = set()
+
+    def start(self):
+        if not self.stop_sets.start_trace():
+            return None
+        return [self.start_ttl]
+
+    def group(self):
+        return id(self.stop_sets)
+
+    def was_probed(self, ttl):
+        return ttl in self.hops or ttl in self.timeouts
+
+    def on_reply(self, ttl, src, reached, rtt):
+        self.hops[ttl] = (src, reached, rtt)
+        return self.__finish(self.__on_reply(ttl, src, reached))
+
+    def on_timeout(self, ttl):
+        self.timeouts.add(ttl)
+        return self.__finish(self.__on_timeout(ttl))
+
+    def __finish(self, ttls):
+        # 每次只有一个探测包，没有新的TTL即探测结束
+        if not ttls:
+            self.stop_sets.end_trace()
+        return ttls
+
+    def __on_reply(self, ttl, src, reached):
+        if self.phase == 'backward':
+            if reached:
+                # 起始TTL超过了到目标的距离，继续反向探测
+                return self.__backward(ttl)
+            if self.stop_sets.in_local(src):
+                return []
+            self.stop_sets.add_local(src)
+            return self.__backward(ttl)
+
+        self.gap = 0
+        if reached:
+            self.reached_ttl = ttl
+            return self.__end_forward()
+        if self.phase == 'forward':
+            hit, remaining = self.stop_sets.lookup_global(src, self.dst)
+            if hit:
+                if remaining is None:
+                    return self.__end_forward()
+                self.phase = 'tail'
+                return self.__forward(max(ttl, ttl + remaining - self.tail_hops - 1))
+        return self.__forward(ttl)
+
+    def __on_timeout(self, ttl):
+        if self.phase == 'backward':
+            return self.__backward(ttl)
+        self.gap += 1
+        if self.gap >= self.gap_limit:
+            return self.__end_forward()
+        return self.__forward(ttl)
+
+    def __forward(self, ttl):
+        if ttl + 1 > self.max_ttl:
+            return self.__end_forward()
+        return [ttl + 1]
+
+    def __backward(self, ttl):
+        return [ttl - 1] if ttl - 1 >= self.min_ttl else []
+
+    def __end_forward(self):
+        # 正向探测中见到的接口加入global停止集合
+        for t, (src, reached, _) in self.hops.items():
+            if t >= self.start_ttl and not reached:
+                remaining = self.reached_ttl - t if self.reached_ttl is not None else None
+                self.stop_sets.add_global(src, self.dst, remaining)
+        self.phase = 'backward'
+        return self.__backward(self.start_ttl)
+
+
+class HopDistanceEstimator(object):
+    """
+    估计到每个目标前缀的跳数：同一前缀中的主机与vantage point的距离几乎相同
+        记录最近>max_samples<次抵达该前缀中目标的TTL，取中位数作为估计值
+        某个前缀已有>max_failures<个探测全部TTL的目标没有抵达（前缀中的主机大多不响应）时，
+        不再为它预热，该前缀的目标直接探测全部TTL（参见failed）
+    """
+    def __init__(self, prefix_length=24, min_samples=3, max_samples=32, max_failures=3):
+        self.prefix_length = prefix_length
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.max_failures = max_failures
+        self.samples = {}
+        # prefix key -> 正在探测全部TTL的目标数量
+        self.warming = {}
+        # prefix key -> 没有抵达目标的预热次数
+        self.failures = {}
+
+    def prefix_key(self, dst):
+        return _ip_to_int(dst) >> (32 - self.prefix_length)
+
+    def add(self, dst, distance):
+        samples = self.samples.setdefault(self.prefix_key(dst), deque(maxlen=self.max_samples))
+        samples.append(distance)
+
+    def estimate(self, dst):
+        """ :return: int, 估计的跳数；样本不足时返回None """
+        samples = self.samples.get(self.prefix_key(dst))
+        if not samples or len(samples) < self.min_samples:
+            return None
+        return sorted(samples)[len(samples) // 2]
+
+    def start_warmup(self, dst):
+        """
+        样本不足时，同一前缀中同时探测全部TTL的目标不超过仍缺少的样本数
+        :return: boolean, False表示应等待正在探测的目标
+        """
+        key = self.prefix_key(dst)
+        samples = self.samples.get(key)
+        warming = self.warming.get(key, 0)
+        if warming + (len(samples) if samples else 0) >= self.min_samples:
+            return False
+        self.warming[key] = warming + 1
+        return True
+
+    def end_warmup(self, dst, reached):
+        key = self.prefix_key(dst)
+        self.warming[key] -= 1
+        if self.warming[key] == 0:
+            del self.warming[key]
+        if not reached:
+            self.failures[key] = self.failures.get(key, 0) + 1
+
+    def failed(self, dst):
+        """ :return: boolean, 该前缀的预热是否已经失败了>max_failures<次 """
+        return self.failures.get(self.prefix_key(dst), 0) >= self.max_failures
+
+
+class AdaptiveTTLStrategy(TraceStrategy):
+    """
+    自适应TTL窗口：同一前缀的前几个目标探测全部TTL，用于估计到该前缀的跳数d（参见HopDistanceEstimator）；
+    之后的目标只探测[d - before, d + after]窗口内的TTL
+        还没有估计值时，该前缀的其他目标推迟开始，等待探测全部TTL的目标结束；
+        预热多次失败的前缀不再推迟，直接探测全部TTL
+        若窗口内第一个TTL就已抵达目标（路径比预期短），则向更小的TTL扩展>step<跳；
+        若没有抵达目标，且最后连续没有响应的TTL少于>gap_limit<个（路径比预期长），则向更大的TTL扩展>step<跳；
+        否则认为目标不响应，不再扩展
+    窗口之外的TTL在rtpath中为UNPROBED（?）
+    """
+    def __init__(self, dst, ttl=range(1, 31), estimator=None, before=2, after=1, step=3, gap_limit=2):
+        TraceStrategy.__init__(self, dst, ttl=ttl)
+        self.estimator = estimator if estimator is not None else HopDistanceEstimator()
+        self.min_ttl, self.max_ttl = min(self.ttl), max(self.ttl)
+        self.before = before
+        self.after = after
+        self.step = step
+        self.gap_limit = gap_limit
+        self.pending = 0
+        self.probed = []
+        self.warmup = False
+
+    def __probe(self, ttls):
+        ttls = [t for t in ttls if self.min_ttl <= t <= self.max_ttl and t not in self.hops]
+        self.pending += len(ttls)
+        self.probed.extend(ttls)
+        return ttls
+
+    def start(self):
+        d = self.estimator.estimate(self.dst)
+        if d is not None:
+            return self.__probe(range(d - self.before, d + self.after + 1))
+        if self.estimator.failed(self.dst):
+            return self.__probe(self.ttl)
+        if not self.estimator.start_warmup(self.dst):
+            return None
+        self.warmup = True
+        return self.__probe(self.ttl)
+
+    def group(self):
+        return self.estimator.prefix_key(self.dst)
+
+    def was_probed(self, ttl):
+        return ttl in self.probed
+
+    def on_reply(self, ttl, src, reached, rtt):
+        self.hops[ttl] = (src, reached, rtt)
+        return self.__resolve()
+
+    def on_timeout(self, ttl):
+        return self.__resolve()
+
+    def __resolve(self):
+        self.pending -= 1
+        if self.pending > 0:
+            return []
+        ttls = self.__next()
+        if not ttls and self.warmup:
+            self.warmup = False
+            self.estimator.end_warmup(self.dst, any(hop[1] for hop in self.hops.values()))
+        return ttls
+
+    def __next(self):
+        reached = [t for t in self.probed if self.hops.get(t, (None, False))[1]]
+        lo, hi = min(self.probed), max(self.probed)
+        if reached:
+            first = min(reached)
+            if first == lo and lo > self.min_ttl:
+                # 路径比预期短
+                return self.__probe(range(lo - self.step, lo))
+            self.estimator.add(self.dst, first)
+            return []
+        gap = 0
+        for t in sorted(self.probed, reverse=True):
+            if t in self.hops:
+                break
+            gap += 1
+        if gap < self.gap_limit and hi < self.max_ttl:
+            # 路径比预期长
+            return self.__probe(range(hi + 1, hi + self.step + 1))
+        return []
+
+
+class ProbeEngine(object):
+    """
+    并发探测引擎，参见模块说明
+    """
+    def __init__(self, backend, pps=1000, window=4096, timeout=2.0, batch_size=256, poll_interval=0.05,
+                 max_deferred=65536):
+        """
+        :param backend: 收发报文的后端，比如SimulatedNetwork或者ScapyBackend
+        :param pps: float
+            发送速率上限（个/秒），None表示不限速
+        :param window: int
+            同时处于探测中的目标数量上限（不包括推迟开始的目标）
+        :param timeout: float
+            探测包的超时时间（秒）
+        :param batch_size: int
+            每次调用backend.send发送的探测包数量上限
+        :param poll_interval: float
+            没有探测包需要发送时，每次等待响应的最长时间（秒）
+        :param max_deferred: int
+            推迟开始的目标数量上限，达到上限时不再取用新的目标
+        """
+        self.backend = backend
+        self.bucket = TokenBucket(pps)
+        self.window = window
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_deferred = max_deferred
+        self.next_probe_id = 0
+        self.stats = {'targets': 0, 'sent': 0, 'replies': 0, 'timeouts': 0, 'seconds': 0.0}
+
+    def run(self, strategies):
+        """
+        探测全部目标
+
+        :param strategies: iterable of TraceStrategy
+            按需取用，可以是生成器（不必一次性生成全部目标）
+        :return: generator of TraceStrategy, 按探测结束的先后顺序返回
+        """
+        strategies = iter(strategies)
+        exhausted = False
+        send_queue = deque()  # (strategy, ttl)
+        in_flight = {}  # probe_id -> (strategy, ttl, send_time)
+        deadlines = deque()  # (deadline, probe_id)，超时时间相同，所以按发送顺序排列即按截止时间排列
+        outstanding = {}  # strategy -> 已安排但尚未完成的探测包数量
+        deferred = {}  # group -> deque of strategy，推迟开始的目标
+        num_deferred = 0
+        ready = {}  # 有目标结束、可以重新尝试推迟的目标的组（按加入的顺序）
+        finished = []
+        start_time = time.monotonic()
+
+        def schedule(strategy, ttls):
+            for t in ttls:
+                send_queue.append((strategy, t))
+            outstanding[strategy] = outstanding.get(strategy, 0) + len(ttls)
+            if outstanding[strategy] == 0:
+                del outstanding[strategy]
+                finished.append(strategy)
+
+        def resolve(strategy, ttls):
+            outstanding[strategy] -= 1
+            schedule(strategy, ttls)
+
+        def start(strategy):
+            ttls = strategy.start()
+            if ttls is None:
+                return False
+            outstanding[strategy] = 0
+            schedule(strategy, ttls)
+            return True
+
+        try:
+            while True:
+                # 补充目标：先重新尝试推迟的目标，再取用新的目标
+                while len(outstanding) < self.window:
+                    if ready:
+                        group = next(iter(ready))
+                        waiting = deferred.get(group)
+                        if waiting and start(waiting[0]):
+                            waiting.popleft()
+                            num_deferred -= 1
+                            if not waiting:
+                                del deferred[group]
+                        else:
+                            del ready[group]
+                        continue
+                    if exhausted or num_deferred >= self.max_deferred:
+                        break
+                    strategy = next(strategies, None)
+                    if strategy is None:
+                        exhausted = True
+                        break
+                    self.stats['targets'] += 1
+                    if not start(strategy):
+                        deferred.setdefault(strategy.group(), deque()).append(strategy)
+                        num_deferred += 1
+
+                if finished:
+                    for strategy in finished:
+                        # 同组的目标探测结束后，在窗口内重新尝试开始该组中推迟的目标
+                        if strategy.group() in deferred:
+                            ready[strategy.group()] = True
+                    while finished:
+                        yield finished.pop(0)
+                    continue
+                if exhausted and not outstanding and not num_deferred:
+                    break
+                if not outstanding and num_deferred:
+                    raise RuntimeError('All remaining targets are deferred.')
+
+                # 在pps预算内发送
+                if send_queue:
+                    n = self.bucket.take(min(len(send_queue), self.batch_size))
+                    if n > 0:
+                        now = time.monotonic()
+                        probes = []
+                        for _ in range(n):
+                            strategy, t = send_queue.popleft()
+                            probe_id = self.next_probe_id
+                            self.next_probe_id = (probe_id + 1) & PROBE_ID_MASK
+                            in_flight[probe_id] = (strategy, t, now)
+                            deadlines.append((now + self.timeout, probe_id))
+                            probes.append(Probe(probe_id, strategy.dst, t))
+                        self.backend.send(probes)
+                        self.stats['sent'] += n
+
+                # 接收响应：还有探测包要发送时，只等到下一个令牌可用
+                now = time.monotonic()
+                wait = self.poll_interval
+                if send_queue:
+                    wait = min(wait, self.bucket.delay())
+                if deadlines:
+                    wait = min(wait, max(0.0, deadlines[0][0] - now))
+                for reply in self.backend.receive(wait):
+                    entry = in_flight.pop(reply.probe_id, None)
+                    if entry is None:
+                        # 重复或者已经超时的响应
+                        continue
+                    strategy, t, send_time = entry
+                    self.stats['replies'] += 1
+                    resolve(strategy, strategy.on_reply(t, reply.src, reply.reached, time.monotonic() - send_time))
+
+                # 处理超时
+                now = time.monotonic()
+                while deadlines and deadlines[0][0] <= now:
+                    _, probe_id = deadlines.popleft()
+                    entry = in_flight.pop(probe_id, None)
+                    if entry is None:
+                        continue
+                    strategy, t, _ = entry
+                    self.stats['timeouts'] += 1
+                    resolve(strategy, strategy.on_timeout(t))
+        finally:
+            self.stats['seconds'] += time.monotonic() - start_time
+
+
+def _mix(x):
+    """ splitmix64：由整数得到均匀分布的64位哈希值，保证模拟网络的结果可复现 """
+    x = (x + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return x ^ (x >> 31)
+
+
+def _ip_to_int(ip):
+    a, b, c, d = ip.split('.')
+    return (int(a) << 24) | (int(b) << 16) | (int(c) << 8) | int(d)
+
+
+def _int_to_ip(n):
+    return '%d.%d.%d.%d' % ((n >> 24) & 0xFF, (n >> 16) & 0xFF, (n >> 8) & 0xFF, n & 0xFF)
+
+
+class SimulatedNetwork(object):
+    """
+    模拟网络后端：根据目标IP确定性地生成路由路径，不发送任何报文
+        前>num_near_hops<跳是所有目标共用的近端路由器；
+        之后依次经过目标所在/16和/24对应的路由器，距离（跳数）由目标所在的/24决定；
+        部分路由器不响应（匿名），部分主机不响应，探测包/响应报文可以按比例随机丢失；
+        响应报文在模拟的时延之后才能被receive取到
+    """
+    def __init__(self, seed=0, num_near_hops=3, min_distance=6, max_distance=14,
+                 anonymous_rate=0.05, unresponsive_rate=0.3, loss_rate=0.0,
+                 base_rtt=0.001, hop_rtt=0.0002):
+        self.seed = seed
+        self.num_near_hops = num_near_hops
+        self.min_distance = min_distance
+        self.max_distance = max_distance
+        self.anonymous_rate = anonymous_rate
+        self.unresponsive_rate = unresponsive_rate
+        self.loss_rate = loss_rate
+        self.base_rtt = base_rtt
+        self.hop_rtt = hop_rtt
+        self.num_sent = 0
+        self.__pending = []  # heap of (due_time, seq, Reply)
+        self.__seq = 0
+
+    def __hash(self, *keys):
+        h = self.seed
+        for k in keys:
+            h = _mix(h ^ k)
+        return h
+
+    def __chance(self, rate, *keys):
+        return self.__hash(*keys) % 1000000 < rate * 1000000
+
+    def distance(self, dst):
+        """ 到目标>dst<（点分十进制）的跳数，即目标所在的TTL """
+        net = _ip_to_int(dst) >> 8
+        return self.min_distance + self.__hash(1, net) % (self.max_distance - self.min_distance + 1)
+
+    def router(self, dst, ttl):
+        """ 到>dst<的路径上第>ttl<跳的路由器接口，匿名路由器返回None """
+        n = _ip_to_int(dst)
+        if ttl <= self.num_near_hops:
+            key = (2, ttl)
+        elif ttl <= (self.num_near_hops + self.distance(dst)) // 2:
+            key = (3, n >> 16, ttl)
+        else:
+            key = (4, n >> 8, ttl)
+        if self.__chance(self.anonymous_rate, 5, *key):
+            return None
+        h = self.__hash(6, *key)
+        # 路由器接口集中在少量/16中
+        return _int_to_ip(((58 + (h >> 40) % 8) << 24) | ((h >> 16) & 0xFF) << 16 | (h & 0xFFFF))
+
+    def route(self, dst):
+        """
+        :return rtpath: list of tuples, 理想情况下（没有丢包）TraceStrategy(dst, ttl=range(1, 31)).rtpath()的结果
+        """
+        distance = self.distance(dst)
+        rtpath = []
+        for t in range(1, min(distance, 31)):
+            src = self.router(dst, t)
+            rtpath.append((t, src) if src else (t, '*'))
+        if distance <= 30:
+            if self.__chance(self.unresponsive_rate, 7, _ip_to_int(dst)):
+                rtpath.extend((t, '*') for t in range(distance, 31))
+            else:
+                rtpath.append((distance, dst, 'EOP'))
+        return rtpath
+
+    def send(self, probes):
+        now = time.monotonic()
+        for probe in probes:
+            self.num_sent += 1
+            if self.loss_rate and self.__chance(self.loss_rate, 8, probe.probe_id, self.num_sent):
+                continue
+            distance = self.distance(probe.dst)
+            if probe.ttl >= distance:
+                if self.__chance(self.unresponsive_rate, 7, _ip_to_int(probe.dst)):
+                    continue
+                reply = Reply(probe.probe_id, probe.dst, True)
+                hops = distance
+            else:
+                src = self.router(probe.dst, probe.ttl)
+                if src is None:
+                    continue
+                reply = Reply(probe.probe_id, src, False)
+                hops = probe.ttl
+            self.__seq += 1
+            heapq.heappush(self.__pending, (now + self.base_rtt + hops * self.hop_rtt, self.__seq, reply))
+
+    def receive(self, timeout):
+        pending = self.__pending
+        now = time.monotonic()
+        if timeout > 0 and (not pending or pending[0][0] > now):
+            time.sleep(min(timeout, pending[0][0] - now) if pending else timeout)
+            now = time.monotonic()
+        replies = []
+        while pending and pending[0][0] <= now:
+            replies.append(heapq.heappop(pending)[2])
+        return replies
+
+    def close(self):
+        self.__pending = []
+
+
+class ScapyBackend(object):
+    """
+    用scapy收发ICMP echo request/响应报文（需要root权限）
+        探测包编号写在ICMP的id（高16位）和seq（低16位）中，
+        time-exceeded/dest-unreach报文引用的原始报文中同样带有这两个字段
+    """
+    def __init__(self, iface=None):
+        from scapy.all import conf, IP, ICMP, IPerror, ICMPerror
+        self.IP, self.ICMP, self.IPerror, self.ICMPerror = IP, ICMP, IPerror, ICMPerror
+        self.__socket = conf.L3socket(iface=iface, filter='icmp')
+
+    def send(self, probes):
+        IP, ICMP = self.IP, self.ICMP
+        for probe in probes:
+            self.__socket.send(IP(dst=probe.dst, ttl=probe.ttl) /
+                               ICMP(id=probe.probe_id >> 16, seq=probe.probe_id & 0xFFFF))
+
+    def __parse(self, pkt):
+        if pkt is None or self.ICMP not in pkt:
+            return None
+        icmp = pkt[self.ICMP]
+        src = pkt[self.IP].src
+        if icmp.type == 0:
+            # echo-reply
+            return Reply((icmp.id << 16) | icmp.seq, src, True)
+        if icmp.type in (3, 11) and self.ICMPerror in pkt:
+            quoted = pkt[self.ICMPerror]
+            # 与traceroute.dst_reached的判断准则相同
+            reached = src == pkt[self.IPerror].dst or (icmp.type == 3 and icmp.code == 3)
+            return Reply((quoted.id << 16) | quoted.seq, src, reached)
+        return None
+
+    def receive(self, timeout):
+        replies = []
+        ready, _, _ = select.select([self.__socket], [], [], timeout)
+        while ready:
+            reply = self.__parse(self.__socket.recv())
+            if reply is not None:
+                replies.append(reply)
+            ready, _, _ = select.select([self.__socket], [], [], 0)
+        return replies
+
+    def close(self):
+        self.__socket.close()
@@ -0,0 +1,79 @@
+# -*- coding:utf-8 -*-
+"""
+probe_engine的测试（使用模拟网络，不发送任何报文）
+
+    python -m pytest NetworkProbing/test_probe_engine.py
+"""
+
+import os
+import sys
+from random import Random
+import pytest
+ROOT = os.path.dirname(os.path.abspath(__file__))
+for path in (ROOT, os.path.join(os.path.dirname(ROOT), 'Util'), os.path.join(os.path.dirname(ROOT), 'SubnetInference')):
+    sys.path.insert(0, path)
+import probe_engine
+import build_ip_topo_graph
+
+
+def make_hosts(n, seed=1):
+    rand = Random(seed)
+    return ['%d.%d.%d.%d' % (rand.choice([11, 12]), rand.randrange(4), rand.randrange(40), rand.randrange(1, 255))
+            for _ in range(n)]
+
+
+def make_engine(network, window=4096, **kwargs):
+    return probe_engine.ProbeEngine(network, pps=None, window=window, timeout=0.05, poll_interval=0.005, **kwargs)
+
+
+def route_links(network, dst):
+    rtpath = build_ip_topo_graph.clean_trace([hop[1] for hop in network.route(dst)])
+    return set(build_ip_topo_graph.extract_links(rtpath)) if rtpath else set()
+
+
+def test_extract_links_does_not_cross_unprobed_hops():
+    rtpath = ['1.0.0.1', '*', '1.0.0.3', '?', '?', '1.0.0.6', '1.0.0.7']
+    assert build_ip_topo_graph.extract_links(rtpath) == [('1.0.0.1', '1.0.0.3', 2), ('1.0.0.6', '1.0.0.7', 1)]
+    assert build_ip_topo_graph.clean_trace(['1.0.0.1', '1.0.0.2', '?', '*', '?']) == ['1.0.0.1', '1.0.0.2']
+
+
+@pytest.mark.parametrize('window', [32, 4096])
+def test_doubletree_links_are_real_links(window):
+    network = probe_engine.SimulatedNetwork(seed=3)
+    stop_sets = probe_engine.StopSets()
+    hosts = make_hosts(2000)
+    engine = make_engine(network, window=window)
+    num_unprobed = 0
+    for target in engine.run(probe_engine.DoubletreeStrategy(dst, ttl=range(1, 16), stop_sets=stop_sets, start_ttl=4)
+                             for dst in hosts):
+        hops = [hop[1] for hop in target.rtpath()]
+        num_unprobed += hops.count(probe_engine.UNPROBED)
+        rtpath = build_ip_topo_graph.clean_trace(hops)
+        if rtpath:
+            assert set(build_ip_topo_graph.extract_links(rtpath)) <= route_links(network, target.dst)
+    assert num_unprobed > 0
+    # 停止集合先播种再放开并发，同时开始的目标也能利用停止集合
+    assert stop_sets.num_finished == len(hosts) and stop_sets.num_active == 0
+    assert engine.stats['sent'] < 0.45 * len(hosts) * 15
+
+
+def run_timed(hosts, strategy, **kwargs):
+    engine = make_engine(probe_engine.SimulatedNetwork(seed=5, unresponsive_rate=0.98), **kwargs)
+    num_targets = sum(1 for _ in engine.run(strategy(dst) for dst in hosts))
+    assert num_targets == len(hosts)
+    return engine.stats
+
+
+@pytest.mark.parametrize('max_deferred', [8, 65536])
+def test_adaptive_throughput_with_unresponsive_prefixes(max_deferred):
+    # 4个/24前缀中几乎所有主机都不响应：预热一直失败，推迟的目标不能让引擎退化为逐个探测
+    rand = Random(2)
+    hosts = ['11.0.%d.%d' % (rand.randrange(4), rand.randrange(1, 255)) for _ in range(600)]
+    ttl = range(3, 16)
+    full = run_timed(hosts, lambda dst: probe_engine.TraceStrategy(dst, ttl=ttl), window=64)
+    estimator = probe_engine.HopDistanceEstimator()
+    adaptive = run_timed(hosts, lambda dst: probe_engine.AdaptiveTTLStrategy(dst, ttl=ttl, estimator=estimator),
+                         window=64, max_deferred=max_deferred)
+    assert all(estimator.failed(dst) or estimator.estimate(dst) is not None for dst in hosts)
+    assert adaptive['sent'] <= full['sent']
+    assert adaptive['seconds'] < 2 * full['seconds']
@@ -1,11 +1,17 @@
 # -*- coding:utf-8 -*-
 
 import networkx
-import ipaddress
 import os.path
 import sys
+import multiprocessing
+from functools import partial
+from itertools import islice
 sys.path.append('../Util')
 import Util
+import Util_ip
+import Util_cache
+import Util_bintrace
+import numpy as np
 
 
 from collections import namedtuple
@@ -41,6 +47,7 @@ def extract_links(rtpath):
     根据一条路由路径抽取IP链路
         e.g. (x.x.x.a -> x.x.x.b) => 返回(x.x.x.a, x.x.x.b, 1)
              (x.x.x.a -> * -> x.x.x.b) => 返回(x.x.x.a, x.x.x.b, 2)
+             (x.x.x.a -> ? -> x.x.x.b) => 没有链路，未探测的跳（?）两侧的IP之间可能隔着任意多跳
 
     :param rtpath: list
         list of IPs
@@ -51,31 +58,80 @@ def extract_links(rtpath):
     link_list = []
     i = 0
     while i < len(rtpath)-1:
-        if rtpath[i] == '*':
+        if rtpath[i] == '*' or rtpath[i] == '?':
             i += 1
             continue
 
         for j in range(i+1, len(rtpath)):
+            if rtpath[j] == '?':
+                i = j
+                break
             if rtpath[j] != '*':
                 link_list.append((rtpath[i], rtpath[j], j-i))
                 i = j
                 break
+        else:
+            break
     return link_list
 
 
-def clean_trace_data(trfile, lazy=True):
+def clean_trace(rtpath):
     """
-    预处理traceroute探测得到的原始数据文件
+    预处理一条路由路径
         1. 将非法IP（比如私有IP）替换为匿名IP（用*表示）
-        2. 将末尾的匿名IP删除：(a, b, c, d, *, *, *, *) => (a, b, c, d)
-        3. 判断路径是否正常，若异常，直接删除该路径
+        2. 将末尾的匿名IP（以及未探测的跳?）删除：(a, b, c, d, *, *, *, *) => (a, b, c, d)
+        3. 判断路径是否正常
+
+    :param rtpath: list
+        list of IPs
+
+    :return rtpath: list
+        预处理后的路由路径；若路径异常，返回None
+    """
+    # 1. 替换非法IP
+    rtpath = Util_ip.replace_non_global(rtpath)
+
+    # 2. 移除末尾的匿名IP
+    for h in range(1, len(rtpath)+1):
+        if rtpath[len(rtpath) - h] not in ('*', '?'):
+            break
+    rtpath = rtpath[:len(rtpath) - h+1]
+
+    # 3. 判断是否正常路径
+    if not Util.is_valid_trace(rtpath):
+        return None
+    return rtpath
+
+
+def clean_trace_line(line):
+    """
+    预处理trace文件中的一行数据，参见clean_trace
+        e.g. "12.5.186.244:\t182.150.24.1 * 171.208.203.101 202.97.65.201 * 202.97.94.98"
+        "\t"前面是目标IP，后面是路由路径
+
+    :return line: string
+        预处理后的一行数据；若路径异常，返回None
+    :return rtpath: list
+        预处理后的路由路径；若路径异常，返回None
+    """
+    items = line.split('\t')
+    rtpath = clean_trace(items[1].split(' '))
+    if rtpath is None:
+        return None, None
+    return items[0] + '\t' + ' '.join(rtpath), rtpath
+
+
+def clean_trace_data(trfile, lazy=True):
+    """
+    预处理traceroute探测得到的原始数据文件，参见clean_trace
 
 
     :param trfile: string
         原始数据文件的完整路径
 
     :param lazy: boolean
-        True: 如果返回文件已经存在，直接跳过，不重新处理
+        True: 如果返回文件已经存在，且原始文件在此之后没有变化（参见Util_cache.FileCache），
+              直接跳过，不重新处理
         False: 不论返回文件是否已经存在，都重新处理一遍
 
     :return OK: boolean
@@ -87,7 +143,7 @@ def clean_trace_data(trfile, lazy=True):
     """
     OK = True
     clnfile = trfile + '_cln'
-    if lazy and os.path.exists(clnfile):
+    if lazy and Util_cache.FileCache(trfile).get('cln'):
         return OK, clnfile
 
     lines = Util.read_to_list(trfile)
@@ -98,29 +154,14 @@ def clean_trace_data(trfile, lazy=True):
         return (not OK), None
 
     for i in range(len(TraceFileHead), len(lines)):
-        # example: "12.5.186.244:\t182.150.24.1 * 171.208.203.101 202.97.65.201 * 202.97.94.98"
-        # "\t"前面是目标IP，后面是路由路径
-        items = lines[i].split('\t')
-        rtpath = items[1].split(' ')
-
-        # 1. 替换非法IP
-        rtpath = [h if h != '*' and ipaddress.IPv4Address(h).is_global else '*' for h in rtpath]
-
-        # 2. 移除末尾的匿名IP
-        for h in range(1, len(rtpath)+1):
-            if rtpath[len(rtpath) - h] != '*':
-                break
-        rtpath = rtpath[:len(rtpath) - h+1]
-
-        # 3. 判断是否正常路径
-        if not Util.is_valid_trace(rtpath):
-            lines[i] = None
-        else:
-            lines[i] = items[0] + '\t' + ' '.join(rtpath)
+        lines[i], _ = clean_trace_line(lines[i])
     # 移除异常路径
     lines = list(filter(None, lines))
     print('Generate cleaned trace file \"{0}\"'.format(os.path.abspath(clnfile)))
-    Util.write_list(lines, clnfile)
+    # 先写临时文件：写出过程被中断时，已登记的_cln文件不会被截断
+    with Util_cache.atomic_filename(clnfile) as tmp_filename:
+        Util.write_list(lines, tmp_filename)
+    Util_cache.FileCache(trfile).put('cln', clnfile)
     return OK, clnfile
 
 
@@ -142,6 +183,9 @@ def load_trace_file(trfile, consecutive=True):
         IP链路数据
     """
     OK = True
+    if trfile.endswith('.btr'):
+        return load_binary_trace_file(trfile, consecutive=consecutive)
+
     lines = Util.read_to_list(trfile)
 
     # 读取文件头部信息
@@ -159,14 +203,248 @@ def load_trace_file(trfile, consecutive=True):
         link_list = extract_links(rtpath)
         link_set.extend(link_list)
 
-    link_set = set(link_set)
+    return OK, trace_head, select_links(set(link_set), consecutive)
+
+
+def iter_binary_trace_file(trfile):
+    """
+    逐条读取二进制trace文件（参见convert_trace_file）中的路由路径，不做任何文本解析
+        若二进制文件未经预处理，则现场调用clean_trace，异常路径直接丢弃
+
+    :return trace_head: dict
+    :return rtpaths: generator of (dst, rtpath)
+        dst: string, 目标IP；rtpath: list of IPs
+    """
+    reader = Util_bintrace.BinaryTraceFile(trfile)
+    trace_head = extract_head(reader.head)
+    names = {}
+
+    def to_str(n):
+        name = names.get(n)
+        if name is None:
+            name = names[n] = Util_ip.int_to_ip(n)
+        return name
+
+    def rtpaths():
+        for dst, _, _, hops, _ in reader:
+            rtpath = [Util_bintrace.MARKER_NAMES.get(h) or to_str(h) for h in hops.tolist()]
+            if not reader.cleaned:
+                rtpath = clean_trace(rtpath)
+                if rtpath is None:
+                    continue
+            yield to_str(dst), rtpath
+
+    return trace_head, rtpaths()
+
+
+def load_binary_trace_file(trfile, consecutive=True):
+    """
+    从二进制trace文件中抽取IP链路，参数和返回值与load_trace_file相同
+    """
+    OK = True
+    trace_head, rtpaths = iter_binary_trace_file(trfile)
+    if not trace_head:
+        return (not OK), None, None
+
+    link_set = set()
+    for _, rtpath in rtpaths:
+        link_set.update(extract_links(rtpath))
+    return OK, trace_head, select_links(link_set, consecutive)
+
+
+def convert_trace_file(trfile, btrfile=None):
+    """
+    将trace文件（原始数据或者预处理后的数据）转换为二进制trace文件（参见Util_bintrace），
+    之后load_trace_file可以直接读取
+
+    :param trfile: string
+    :param btrfile: string
+        二进制文件名，默认为trfile + '.btr'
+
+    :return OK: boolean
+    :return btrfile: string
+    """
+    OK = True
+    if btrfile is None:
+        btrfile = trfile + '.btr'
+    lines = Util.iter_lines(trfile)
+    head_lines = list(islice(lines, len(TraceFileHead)))
+    trace_head = extract_head(head_lines)
+    if not trace_head:
+        return (not OK), None
+
+    intern_table = Util_ip.IpInternTable()
+    vp = intern_table.intern(trace_head[TraceFileHead.src])
+    with Util_bintrace.BinaryTraceWriter(btrfile, fmt='tab', head=head_lines,
+                                         cleaned=trfile.endswith('_cln')) as writer:
+        for line in lines:
+            # example: "-12.5.186.244:\t182.150.24.1 * 171.208.203.101 202.97.65.201 * 202.97.94.98"
+            # '+'/'-'表示是否到达目标IP
+            items = line.split('\t')
+            dst = items[0].rstrip(':')
+            flags = 0
+            if dst[0] in '+-':
+                flags = Util_bintrace.FLAG_MARKED | (Util_bintrace.FLAG_REACHED if dst[0] == '+' else 0)
+                dst = dst[1:]
+            hops = [Util_bintrace.MARKERS[h] if h in Util_bintrace.MARKERS else intern_table.intern(h)
+                    for h in items[1].split(' ')]
+            writer.add_trace(dst=intern_table.intern(dst), vp=vp, hops=hops, flags=flags)
+    return OK, btrfile
+
+
+def clean_and_load_trace_file(trfile, consecutive=True, write_cln=False, cache=False):
+    """
+    在同一遍扫描中完成clean_trace_data和load_trace_file的工作：
+    逐行读取原始数据文件，预处理后直接抽取IP链路，不必先写出_cln文件再读回来解析
+
+    :param trfile: string
+        原始数据文件的完整路径
+
+    :param consecutive: boolean
+        参见load_trace_file
+
+    :param write_cln: boolean
+        True: 同时写出预处理后的数据文件（trfile + '_cln'），内容与clean_trace_data相同
+
+    :param cache: boolean
+        True: 若原始文件没有变化，直接读取上次保存的二进制链路快照（参见save_link_snapshot），
+              跳过所有文本解析；否则重新处理并保存快照
+
+    :return: 与load_trace_file相同
+    """
+    OK = True
+    if trfile.endswith('.btr'):
+        # 二进制文件不必（也无法）写出_cln文件
+        return load_binary_trace_file(trfile, consecutive=consecutive)
+
+    if cache:
+        snapshot = Util_cache.FileCache(trfile).get('links')
+        if snapshot:
+            trace_head, link_set = load_link_snapshot(snapshot)
+            return OK, trace_head, select_links(link_set, consecutive)
+
+    lines = Util.iter_lines(trfile)
+
+    # 读取文件头部信息
+    head_lines = list(islice(lines, len(TraceFileHead)))
+    trace_head = extract_head(head_lines)
+    if not trace_head:
+        return (not OK), None, None
+
+    # 预处理并抽取链路信息
+    link_set = set()
+
+    def cleaned_lines():
+        for line in head_lines:
+            yield line
+        for line in lines:
+            line, rtpath = clean_trace_line(line)
+            if rtpath is None:
+                continue
+            link_set.update(extract_links(rtpath))
+            yield line
+
+    if write_cln:
+        clnfile = trfile + '_cln'
+        with Util_cache.atomic_filename(clnfile) as tmp_filename:
+            Util.write_lines(cleaned_lines(), tmp_filename)
+        Util_cache.FileCache(trfile).put('cln', clnfile)
+        print('Generate cleaned trace file \"{0}\"'.format(os.path.abspath(clnfile)))
+    else:
+        for _ in cleaned_lines():
+            pass
+
+    if cache:
+        snapshot = trfile + '.links.npz'
+        save_link_snapshot(snapshot, trace_head, link_set)
+        Util_cache.FileCache(trfile).put('links', snapshot)
+    return OK, trace_head, select_links(link_set, consecutive)
+
+
+def save_link_snapshot(filename, trace_head, link_set):
+    """
+    将文件头部信息和所有IP链路（3元组）保存为二进制快照（.npz）
+        链路两端地址保存为uint32，间隔保存为uint8
+    """
+    link_set = list(link_set)
+    Util_cache.save_arrays(filename,
+                           head_keys=np.array(list(trace_head.keys()), dtype=str),
+                           head_values=np.array(list(trace_head.values()), dtype=str),
+                           src=np.fromiter((Util_ip.ip_to_int(link[0]) for link in link_set),
+                                           dtype=np.uint32, count=len(link_set)),
+                           dst=np.fromiter((Util_ip.ip_to_int(link[1]) for link in link_set),
+                                           dtype=np.uint32, count=len(link_set)),
+                           gap=np.fromiter((link[2] for link in link_set),
+                                           dtype=np.uint8, count=len(link_set)))
+
+
+def load_link_snapshot(filename):
+    """
+    :return trace_head: dict
+    :return link_set: set of 3-elements tuples
+    """
+    arrays = Util_cache.load_arrays(filename)
+    trace_head = dict(zip(arrays['head_keys'].tolist(), arrays['head_values'].tolist()))
+    link_set = set((Util_ip.int_to_ip(u), Util_ip.int_to_ip(v), g) for u, v, g in
+                   zip(arrays['src'].tolist(), arrays['dst'].tolist(), arrays['gap'].tolist()))
+    return trace_head, link_set
+
+
+def select_links(link_set, consecutive=True):
+    """
+    :param link_set: set of 3-elements tuples
+        (x.x.x.a, x.x.x.b, 间隔)
+
+    :param consecutive: boolean
+        参见load_trace_file
+    """
     if consecutive:
         link_set = set(filter(lambda x: x[2] == 1, link_set))
         link_set = set(item[:2] for item in link_set)
     else:
         # todo, 处理匿名路由器
         pass
-    return OK, trace_head, link_set
+    return link_set
+
+
+def load_trace_files(trfiles, consecutive=True, processes=None):
+    """
+    用进程池并行处理多个原始数据文件（参见clean_and_load_trace_file），并合并所有文件的IP链路
+
+    :param trfiles: list of strings
+        原始数据文件的完整路径
+
+    :param consecutive: boolean
+        参见load_trace_file
+
+    :param processes: int
+        进程数，None表示使用全部CPU核；1表示在当前进程中串行处理
+
+    :return OK: boolean
+        True: 至少一个文件处理成功
+
+    :return trace_heads: dict
+        key: string, 文件名
+        value: dict, 对应文件的头部信息
+
+    :return link_set: set of 2/3-elements tuples
+        所有文件的IP链路的并集
+    """
+    worker = partial(clean_and_load_trace_file, consecutive=consecutive)
+    if processes == 1 or len(trfiles) <= 1:
+        results = list(map(worker, trfiles))
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(worker, trfiles)
+
+    trace_heads, link_set = {}, set()
+    for trfile, (stat, trace_head, links) in zip(trfiles, results):
+        if not stat:
+            print('Failed to load \"{0}\"'.format(os.path.abspath(trfile)))
+            continue
+        trace_heads[trfile] = trace_head
+        link_set.update(links)
+    return len(trace_heads) > 0, trace_heads, link_set
 
 
 def build_topo_graph(trace_head, link_set):
@@ -176,7 +454,21 @@ def build_topo_graph(trace_head, link_set):
     return g
 
 
-def main(filename):
+def main(filename, fused=True, write_cln=True):
+    """
+    :param fused: boolean
+        True: 预处理和链路抽取在同一遍扫描中完成，参见clean_and_load_trace_file
+        False: 先生成_cln文件，再从中抽取链路
+
+    :param write_cln: boolean
+        fused=True时，是否同时写出_cln文件
+    """
+    if fused:
+        stat, trace_head, link_set = clean_and_load_trace_file(trfile=filename, write_cln=write_cln)
+        if stat:
+            return stat, build_topo_graph(trace_head, link_set)
+        return stat, None
+
     stat, clnfile = clean_trace_data(trfile=filename, lazy=False)
     if stat:
         stat, trace_head, link_set = load_trace_file(trfile=clnfile)
@@ -1,54 +1,252 @@
 #! python
 # -*- coding:utf-8 -*-
-from random import shuffle
+from functools import partial
 import ipaddress
+import json
 import socket
+import time
+import os
 import sys
 sys.path.append('../NetworkProbing/')
 sys.path.append('../Util')
-import traceroute
+import probe_engine
+import Util_ip
+import Util_cache
 import Util
 
 
-def main(datadir, ttl=range(1, 26), repeat=1):
+def probe_hosts(hosts, ttl, engine=None, strategy=probe_engine.TraceStrategy):
+    """
+    探测>hosts<中的每个目标
+
+    :param hosts: iterable of ipaddress.IPv4Address
+    :param ttl: range
+    :param engine: probe_engine.ProbeEngine
+        None: 用traceroute.traceroutefast逐个探测，每个目标都要等待超时
+        否则用并发探测引擎同时探测多个目标，结果按探测结束的先后顺序返回
+    :param strategy: callable
+        strategy(dst, ttl=ttl)返回一个目标的探测策略（参见probe_engine.TraceStrategy），只对探测引擎有效
+    :return: generator of (dst, rtpath)
+        rtpath: 参见traceroute.traceroutefast
+    """
+    if engine is None:
+        # 只有逐个探测时才需要导入scapy，使用模拟网络的探测引擎可以离线运行
+        import traceroute
+        for dst in hosts:
+            yield dst, traceroute.traceroutefast(str(dst), timeout=1, ttl=ttl, ostr=False)
+    else:
+        for target in engine.run(strategy(dst, ttl=ttl) for dst in hosts):
+            yield target.dst, target.rtpath()
+
+
+def format_trace_line(dst, rtpath):
+    """
+    :param rtpath: list of tuples, 参见traceroute.traceroutefast
+    :return line: string, trace文件中的一行
+        每个TTL一项：*为匿名路由器（发出了探测包但没有响应），
+        ?为探测策略跳过、没有发出探测包的TTL（参见probe_engine.UNPROBED，比如Doubletree）；
+        *两侧的IP之间是间隔若干跳的链路，?两侧的IP之间不能构成链路（参见build_ip_topo_graph.extract_links）
+    """
+    # 必须先获取EOP状态
+    dst_reached = (rtpath[-1][-1] == 'EOP')
+    rtpath = [item[1] for item in rtpath]
+    if dst_reached:
+        # We have reached the destination
+        return '+' + str(dst) + ':\t' + ' '.join(rtpath)
+    # We MAY have not reached the destination
+    return '-' + str(dst) + ':\t' + ' '.join(rtpath)
+
+
+class TraceWriter(object):
+    """
+    只追加写入的trace文件：每条路径写为一行（以换行符结尾），先进入缓冲区，
+    缓冲区满时写出，每隔>fsync_interval<秒做一次检查点，进程被中断时最多损失最近一个检查点之后的路径
+        进度以(轮次, 排列中的位置)表示（参见Util_ip.HostPermutation）：
+            round: 当前轮次
+            position: 当前轮次中，位置小于position的目标都已经写入
+            ahead: 位置不小于position、但已经提前写入的目标（并发探测时按结束的先后顺序写入，
+                   其数量不超过同时探测的目标数）
+        检查点：写出缓冲区并fsync，再把进度和此时的文件大小写入>tracefile<.ckpt；
+        续写（resume）时只读取文件头部和检查点，把trace文件截断到检查点时的大小（丢弃之后的路径以及不完整的末行），
+        内存占用与已经探测的目标数量无关；没有检查点的文件只截掉不完整的末行，从第一轮开始续写
+    """
+    def __init__(self, tracefile, head, resume=False, buffer_lines=1000, fsync_interval=30.0):
+        """
+        :param tracefile: string
+        :param head: list of strings
+            文件头部（Vantage, Destination, TTL三行）
+        :param resume: boolean
+            True: 若文件已存在，从检查点续写；要求Destination和TTL与>head<一致
+            False: 覆盖已存在的文件
+        :param buffer_lines: int
+            缓冲区的行数
+        :param fsync_interval: float
+            检查点的时间间隔（秒）
+        """
+        self.tracefile = tracefile
+        self.checkpoint_filename = tracefile + '.ckpt'
+        self.buffer_lines = buffer_lines
+        self.fsync_interval = fsync_interval
+        self.round = 0
+        self.position = 0
+        self.ahead = set()
+        self.__buffer = []
+
+        if resume and self.__load(head):
+            self.__file = open(tracefile, 'a')
+        else:
+            self.__file = open(tracefile, 'w')
+            self.__file.write(''.join(line + '\n' for line in head))
+            self.checkpoint()
+        self.__last_fsync = time.monotonic()
+
+    def __load(self, head):
+        """ 读取检查点，并把trace文件截断到检查点时的大小，返回是否可以续写 """
+        if not os.path.exists(self.tracefile):
+            return False
+        with open(self.tracefile, 'r') as f:
+            lines = [f.readline() for _ in head]
+        if not all(line.endswith('\n') for line in lines):
+            return False
+        if [line.rstrip('\n') for line in lines[1:]] != head[1:]:
+            raise ValueError('Cannot resume \"{0}\": the trace file head is not consistent.'
+                             .format(os.path.abspath(self.tracefile)))
+        if not os.path.exists(self.checkpoint_filename):
+            # 没有检查点（比如旧版本写出的文件）：保留已有的完整行，从第一轮开始
+            Util.truncate_torn_line(self.tracefile)
+            print('Resume \"{0}\": no checkpoint, start from the first round.'.format(os.path.abspath(self.tracefile)))
+            return True
+        with open(self.checkpoint_filename, 'r') as f:
+            checkpoint = json.load(f)
+        with open(self.tracefile, 'rb+') as f:
+            f.truncate(checkpoint['size'])
+        self.round = checkpoint['round']
+        self.position = checkpoint['position']
+        self.ahead = set(checkpoint['ahead'])
+        print('Resume \"{0}\": round {1}, position {2}.'
+              .format(os.path.abspath(self.tracefile), self.round, self.position + len(self.ahead)))
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def is_done(self, position):
+        """ 当前轮次中位置为>position<的目标是否已经写入 """
+        return position < self.position or position in self.ahead
+
+    def write(self, dst, rtpath, position):
+        """
+        写入目标>dst<的一条路径，参见format_trace_line
+        :param position: int, >dst<在当前轮次的排列中的位置
+        """
+        self.__buffer.append(format_trace_line(dst, rtpath) + '\n')
+        self.ahead.add(position)
+        while self.position in self.ahead:
+            self.ahead.remove(self.position)
+            self.position += 1
+        if len(self.__buffer) >= self.buffer_lines:
+            self.flush()
+        if time.monotonic() - self.__last_fsync >= self.fsync_interval:
+            self.checkpoint()
+
+    def next_round(self):
+        """ 当前轮次的全部目标都已写入，进入下一轮 """
+        self.round += 1
+        self.position = 0
+        self.ahead = set()
+        self.checkpoint()
+
+    def flush(self):
+        if self.__buffer:
+            self.__file.write(''.join(self.__buffer))
+            self.__buffer = []
+        self.__file.flush()
+
+    def checkpoint(self):
+        """ 写出缓冲区并fsync，再保存进度；此前写入的路径在进程或者系统崩溃后都不会丢失 """
+        self.flush()
+        os.fsync(self.__file.fileno())
+        checkpoint = {'round': self.round,
+                      'position': self.position,
+                      'ahead': sorted(self.ahead),
+                      'size': os.fstat(self.__file.fileno()).st_size}
+        with Util_cache.atomic_filename(self.checkpoint_filename) as tmp_filename:
+            with open(tmp_filename, 'w') as f:
+                json.dump(checkpoint, f)
+                f.flush()
+                os.fsync(f.fileno())
+        self.__last_fsync = time.monotonic()
+
+    def close(self):
+        if not self.__file.closed:
+            self.checkpoint()
+            self.__file.close()
+
+
+def main(datadir, ttl=range(1, 26), repeat=1, engine=None, resume=False, doubletree=False, adaptive=False,
+         seed=0):
+    """
+    :param engine: probe_engine.ProbeEngine
+        参见probe_hosts
+    :param resume: boolean
+        True: 在已有的trace文件后续写，跳过已经探测过的目标（参见TraceWriter）
+    :param doubletree: boolean
+        True: 用Doubletree策略探测（参见probe_engine.DoubletreeStrategy），
+              所有目标网络共用同一组停止集合，近端和已知的路径不再重复探测；需要探测引擎
+    :param adaptive: boolean
+        True: 用自适应TTL窗口探测（参见probe_engine.AdaptiveTTLStrategy），
+              每个前缀的前几个目标探测全部TTL，其余目标只探测最后几跳附近的TTL；需要探测引擎
+    :param seed: int
+        每一轮按Util_ip.HostPermutation的伪随机顺序探测目标网络中的主机，相同的>seed<得到相同的顺序
+    """
+    strategy = probe_engine.TraceStrategy
+    if (doubletree or adaptive) and engine is None:
+        raise ValueError('Doubletree or adaptive probing requires a probe engine.')
+    if doubletree and adaptive:
+        raise ValueError('Doubletree and adaptive probing cannot be used together.')
+    if doubletree:
+        strategy = partial(probe_engine.DoubletreeStrategy, stop_sets=probe_engine.StopSets())
+    if adaptive:
+        strategy = partial(probe_engine.AdaptiveTTLStrategy, estimator=probe_engine.HopDistanceEstimator())
+
     subnet_list = Util.read_to_list(datadir + 'IpBlocks.txt')
     for net in subnet_list:
         if net.startswith('#'):
             continue
         print('Probing:', net)
         net = ipaddress.IPv4Network(net)
-        host_list = list(net.hosts())
 
         count = 0
-        ret_data = ['Vantage:\t' + socket.gethostbyname(socket.gethostname()),
-                    'Destination:\t' + str(net),
-                    'TTL:\t' + ' '.join([str(t) for t in ttl])]
-
-        while repeat > 0:
-            repeat -= 1
-            shuffle(host_list)
-            for dst in host_list:
-                rtpath = traceroute.traceroutefast(str(dst), timeout=1, ttl=ttl, ostr=False)
-                # 必须先获取EOP状态
-                dst_reached = (rtpath[-1][-1] == 'EOP')
-                rtpath = [item[1] for item in rtpath]
-                if dst_reached:
-                    # We have reached the destination
-                    ret_data.append('+' + str(dst) + ':\t' + ' '.join(rtpath))
-                else:
-                    # We MAY have not reached the destination
-                    ret_data.append('-' + str(dst) + ':\t' + ' '.join(rtpath))
-                count += 1
-                if count % 1e3 == 0:
-                    print(count, 'IPs are probed.')
-
-                rtpath.append('Reached the destination!' if dst_reached else 'MAY not reached the destination!')
-                Util.write_list(rtpath, 'trace.tmp')
-
+        head = ['Vantage:\t' + socket.gethostbyname(socket.gethostname()),
+                'Destination:\t' + str(net),
+                'TTL:\t' + ' '.join([str(t) for t in ttl])]
         tracefile = datadir + str(net.network_address) + '-' + str(net.prefixlen) + '.trace'
-        Util.write_list(ret_data, tracefile)
+
+        with TraceWriter(tracefile, head, resume=resume) as writer:
+            # 正在探测的目标 -> 在排列中的位置，数量不超过同时探测的目标数
+            positions = {}
+
+            def hosts(permutation):
+                # 跳过当前轮次中已经写入的位置（续写时）
+                for position, dst in enumerate(permutation):
+                    if not writer.is_done(position):
+                        dst = ipaddress.IPv4Address(dst)
+                        positions[str(dst)] = position
+                        yield dst
+
+            while writer.round < repeat:
+                permutation = Util_ip.HostPermutation(net, seed='{0}/{1}'.format(seed, writer.round))
+                for dst, rtpath in probe_hosts(hosts(permutation), ttl, engine=engine, strategy=strategy):
+                    writer.write(dst, rtpath, positions.pop(str(dst)))
+                    count += 1
+                    if count % 1e3 == 0:
+                        print(count, 'IPs are probed.')
+                writer.next_round()
 
 
 if __name__ == '__main__':
     datadir = './Dataset/Test/'
-    main(datadir, ttl=range(3, 16), repeat=5)
+    main(datadir, ttl=range(3, 16), repeat=5, resume=True)
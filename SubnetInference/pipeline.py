@@ -1,10 +1,16 @@
 # -*- coding:utf-8 -*-
 
 import os
+import sys
+import json
 import ipaddress
+import multiprocessing
 from collections import Counter
 import measure_routing_path
 import build_ip_topo_graph
+sys.path.append('../Util')
+import Util_ip
+import Util
 
 
 def predecessor_analysis(ip_graph, verbose=0):
@@ -22,39 +28,196 @@ def predecessor_analysis(ip_graph, verbose=0):
         value: set of strings, 对应节点的前驱节点集合
     """
     dst_net = ipaddress.IPv4Network(ip_graph.graph[build_ip_topo_graph.TraceFileHead.dst])
-    reached_hosts = set([str(h) for h in dst_net.hosts()])
-    reached_hosts = reached_hosts.intersection(set(ip_graph.nodes))
+    # 只比较整数地址的范围，不生成目标网络的主机列表
+    first, last = Util_ip.host_range(dst_net)
+    reached_hosts = [n for n in ip_graph.nodes if first <= Util_ip.ip_to_int(n) <= last]
     print('Number of reached hosts:', len(reached_hosts))
     node2pred = {}
     for node in reached_hosts:
         node2pred[node] = set([pred for pred in ip_graph.predecessors(node)])
 
     if verbose >= 1:
-        num_preds = [len(pset) for pset in node2pred.values()]
-        num_preds_to_num_nodes = Counter(num_preds)
-        num_multi_pred_nodes = sum([nn for np, nn in num_preds_to_num_nodes.items() if np > 1])
-        print('(num_preds, num_IPs) =', sorted(num_preds_to_num_nodes.items(), key=lambda x: x[0]))
+        print_predecessor_statistics(node2pred)
+
+    return node2pred
+
+
+def print_predecessor_statistics(node2pred):
+    num_preds = [len(pset) for pset in node2pred.values()]
+    num_preds_to_num_nodes = Counter(num_preds)
+    num_multi_pred_nodes = sum([nn for np, nn in num_preds_to_num_nodes.items() if np > 1])
+    print('(num_preds, num_IPs) =', sorted(num_preds_to_num_nodes.items(), key=lambda x: x[0]))
+    if num_multi_pred_nodes + num_preds_to_num_nodes[1] > 0:
         print('>>>> {r:2.1f}% IPs have multiple predecessors.'
               .format(r=100.0 * num_multi_pred_nodes / (num_multi_pred_nodes + num_preds_to_num_nodes[1])))
 
-    return node2pred
 
+def batch_predecessor_analysis(trfiles, prefixes=None, processes=None, verbose=0):
+    """
+    批量分析多个trace文件、多个目标网络：所有文件的IP链路合并为一张图，
+    用有序区间索引（Util_ip.PrefixIndex）把每个节点映射到其所在的目标网络，
+    一遍扫描即可得到所有目标网络中可达IP的前驱节点
 
-def main():
-    datadir = './Dataset/Test/'
-    if False:
-        measure_routing_path.main(datadir)
+    :param trfiles: list of strings
+        原始数据文件的完整路径
+    :param prefixes: iterable of strings or ipaddress.IPv4Network
+        目标网络；None表示使用各文件头部的Destination
+    :param processes: int
+        参见build_ip_topo_graph.load_trace_files
+    :param verbose: int
+        控制信息输出
 
-    # trfiles = [datadir + item for item in os.listdir(datadir) if item.endswith('.trace')]
-    trfiles = [datadir + item for item in ['61.63.92.0-22.trace']]
-    for trfile in trfiles:
-        # 为每个trace文件处理一次
-        print('Processing \"{0}\"'.format(os.path.abspath(trfile)))
+    :return prefix2node2pred: dict
+        key: ipaddress.IPv4Network, 目标网络（节点同时属于嵌套的多个网络时，只计入最长的前缀）
+        value: dict, 与predecessor_analysis的返回值相同
+    """
+    stat, trace_heads, link_set = build_ip_topo_graph.load_trace_files(trfiles, processes=processes)
+    if not stat:
+        return {}
+    if prefixes is None:
+        prefixes = [trace_head[build_ip_topo_graph.TraceFileHead.dst] for trace_head in trace_heads.values()]
+    index = Util_ip.PrefixIndex(prefixes, hosts_only=True)
+    g = build_ip_topo_graph.build_topo_graph({}, link_set)
+
+    prefix2node2pred = {prefix: {} for prefix in index.prefixes}
+    nodes = list(g.nodes)
+    addresses = [Util_ip.ip_to_int(n) for n in nodes]
+    for node, i in zip(nodes, index.lookup_array(addresses).tolist()):
+        if i >= 0:
+            prefix2node2pred[index.prefixes[i]][node] = set(g.predecessors(node))
+
+    if verbose >= 1:
+        for prefix, node2pred in prefix2node2pred.items():
+            print('Target network {0}: {1} reached hosts'.format(prefix, len(node2pred)))
+            print_predecessor_statistics(node2pred)
+    return prefix2node2pred
+
+
+def analyze_trace_file(trfile):
+    """
+    处理单个trace文件：抽取IP链路并分析可达IP的前驱节点，结果写入trfile + '.pred.json'
+        供进程池调用（必须是模块级函数才能被pickle），任何异常都记录在返回值中，不会中断其他文件
+
+    :return record: dict, 写入检查点清单的一条记录
+        file: 文件的绝对路径
+        size, mtime_ns: 处理时文件的大小和修改时间，文件变化后需要重新处理
+        status: 'done'或者'failed'
+        dst, num_reached_hosts, num_preds: 目标网络，可达IP数，(前驱数, IP数)的统计（仅'done'）
+        result: 前驱节点的结果文件（仅'done'）
+        error: 异常信息（仅'failed'）
+    """
+    trfile = os.path.abspath(trfile)
+    st = os.stat(trfile)
+    record = {'file': trfile, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    try:
         stat, g = build_ip_topo_graph.main(trfile)
-        if stat:
-            node2pred = predecessor_analysis(ip_graph=g, verbose=1)
+        if not stat:
+            record.update(status='failed', error='failed to load the trace file')
+            return record
+        node2pred = predecessor_analysis(ip_graph=g)
+        result = trfile + '.pred.json'
+        tmp_result = result + '.tmp'
+        with open(tmp_result, 'w') as f:
+            json.dump({node: sorted(preds) for node, preds in node2pred.items()}, f)
+        os.replace(tmp_result, result)
+        record.update(status='done',
+                      dst=g.graph[build_ip_topo_graph.TraceFileHead.dst],
+                      num_reached_hosts=len(node2pred),
+                      num_preds=sorted(Counter(len(preds) for preds in node2pred.values()).items()),
+                      result=result)
+    except Exception as e:
+        record.update(status='failed', error='{0}: {1}'.format(type(e).__name__, e))
+    return record
+
+
+def load_manifest(manifest):
+    """
+    读取检查点清单（每行一条json记录，参见analyze_trace_file），同一文件以最后一条记录为准
+        进程在写入过程中被中断时，最后一行可能不完整，直接忽略（run_pipeline追加之前会截掉该行）
+
+    :return file2record: dict
+    """
+    file2record = {}
+    if not os.path.exists(manifest):
+        return file2record
+    with open(manifest, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            file2record[record['file']] = record
+    return file2record
+
+
+def is_finished(record, trfile):
+    """ 清单中的记录是否表明>trfile<已经处理完成，且此后没有变化 """
+    if record is None or record.get('status') != 'done' or not os.path.exists(record.get('result', '')):
+        return False
+    st = os.stat(trfile)
+    return record['size'] == st.st_size and record['mtime_ns'] == st.st_mtime_ns
+
+
+def run_pipeline(datadir, processes=None, manifest=None, suffix='.trace'):
+    """
+    用进程池处理>datadir<中的全部trace文件，每处理完一个文件就在检查点清单中追加一条记录；
+    重新运行时跳过已经完成且没有变化的文件，失败的文件会重试
+
+    :param datadir: string
+        数据目录，比如'./Dataset/AS109/'
+    :param processes: int
+        进程数，None表示使用全部CPU核；1表示在当前进程中串行处理
+    :param manifest: string
+        检查点清单的文件名，默认为datadir中的'pipeline_manifest.jsonl'
+    :param suffix: string
+        trace文件的后缀
+
+    :return file2record: dict
+        key: trace文件的绝对路径
+        value: dict, 该文件的最新记录
+    """
+    if manifest is None:
+        manifest = os.path.join(datadir, 'pipeline_manifest.jsonl')
+    trfiles = sorted(os.path.abspath(os.path.join(datadir, item))
+                     for item in os.listdir(datadir) if item.endswith(suffix))
+    file2record = load_manifest(manifest)
+    todo = [trfile for trfile in trfiles if not is_finished(file2record.get(trfile), trfile)]
+    print('{0} trace files, {1} finished, {2} to process'.format(len(trfiles), len(trfiles) - len(todo), len(todo)))
+    if not todo:
+        return {trfile: file2record[trfile] for trfile in trfiles}
+
+    def records():
+        if processes == 1 or len(todo) <= 1:
+            for trfile in todo:
+                yield analyze_trace_file(trfile)
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                for record in pool.imap_unordered(analyze_trace_file, todo):
+                    yield record
+
+    # 截掉中断时留下的不完整末行，否则新记录会拼接在残行之后，导致整行无法解析
+    Util.truncate_torn_line(manifest)
+    with open(manifest, 'a') as f:
+        for i, record in enumerate(records()):
+            # 每条记录都立即落盘，中断后最多损失正在处理的文件
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+            file2record[record['file']] = record
+            print('[{0}/{1}] {2} \"{3}\"'.format(i + 1, len(todo), record['status'], record['file']))
+    return {trfile: file2record[trfile] for trfile in trfiles}
+
+
+def main(datadir='./Dataset/Test/', processes=None):
+    if False:
+        measure_routing_path.main(datadir)
 
+    file2record = run_pipeline(datadir, processes=processes)
+    failed = [trfile for trfile, record in file2record.items() if record['status'] != 'done']
+    print('{0} files done, {1} failed'.format(len(file2record) - len(failed), len(failed)))
+    for trfile in failed:
+        print('Failed: \"{0}\": {1}'.format(trfile, file2record[trfile].get('error')))
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main(*sys.argv[1:2])
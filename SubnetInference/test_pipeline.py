@@ -0,0 +1,58 @@
+# -*- coding:utf-8 -*-
+"""
+pipeline的测试
+
+    python -m pytest SubnetInference/test_pipeline.py
+"""
+
+import os
+import sys
+import json
+import shutil
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in ('Util', 'NetworkProbing', 'SubnetInference'):
+    sys.path.insert(0, os.path.join(ROOT, path))
+import pipeline
+
+DATASET = os.path.join(ROOT, 'SubnetInference', 'Dataset', 'Test')
+
+
+def make_datadir(tmp_path):
+    for item in os.listdir(DATASET):
+        if item.endswith('.trace'):
+            shutil.copy(os.path.join(DATASET, item), str(tmp_path))
+    return str(tmp_path)
+
+
+def read_records(manifest):
+    with open(manifest, 'r') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_resume_from_torn_manifest(tmp_path):
+    datadir = make_datadir(tmp_path)
+    manifest = os.path.join(datadir, 'pipeline_manifest.jsonl')
+    file2record = pipeline.run_pipeline(datadir, processes=1)
+    assert len(file2record) == 2
+    assert all(record['status'] == 'done' for record in file2record.values())
+
+    # 模拟写入最后一条记录时进程崩溃：末行只写了一半，没有换行符
+    with open(manifest, 'rb') as f:
+        data = f.read()
+    last_start = data.rstrip(b'\n').rfind(b'\n') + 1
+    torn_file = json.loads(data[last_start:].decode())['file']
+    with open(manifest, 'wb') as f:
+        f.write(data[:last_start + 20])
+    assert torn_file not in pipeline.load_manifest(manifest)
+
+    # 续跑只重新处理残行对应的文件，新记录不能拼接在残行之后
+    file2record = pipeline.run_pipeline(datadir, processes=1)
+    assert all(record['status'] == 'done' for record in file2record.values())
+    records = read_records(manifest)
+    assert len(records) == 2
+    assert records[-1]['file'] == torn_file
+
+    # 再次运行时全部文件都已完成，清单不变
+    pipeline.run_pipeline(datadir, processes=1)
+    assert read_records(manifest) == records
+    assert all(pipeline.is_finished(record, trfile) for trfile, record in pipeline.load_manifest(manifest).items())
@@ -20,6 +20,22 @@ def read_to_list(filename):
     return data_list
 
 
+def iter_lines(filename):
+    """
+    逐行读取文件，read_to_list的生成器版本，适用于无法一次性读入内存的大文件
+    每行的处理方式与read_to_list相同
+    """
+    if not os.path.exists(filename):
+        print('The file \"{0}\" does not exist.'.format(os.path.abspath(filename)))
+        return
+    try:
+        with open(filename, 'r') as f:
+            for line in f:
+                yield line.rstrip('\n').rstrip('\r').rstrip(' ')
+    except IOError:
+        print('The file \"{0}\" is not readable.'.format(os.path.abspath(filename)))
+
+
 def list_to_str(data_list, sep=' '):
     """
     !!! 不再使用这个函数，用str.join() !!!
@@ -68,6 +84,72 @@ def write_list(data_list, filename, mode='w'):
                 f.write('\n' + data_list[i])
 
 
+def is_valid_trace(rtpath):
+    """
+    判断traceroute探测得到的一条路由路径是否正确
+        1. 至少包含两个非匿名IP
+        2. 每个非匿名IP只出现一次（没有路由环路）
+        3. 至少存在连续两个非匿名IP，即至少包含一条链路
+
+    :param rtpath: list
+        routing path, IP地址列表，匿名IP用*表示，未探测的跳用?表示
+
+    :return ret: boolean
+    """
+    ip_non_anonymous_list = [h for h in rtpath if h != '*' and h != '?']
+    if len(ip_non_anonymous_list) < 2:
+        return False
+    if len(ip_non_anonymous_list) != len(set(ip_non_anonymous_list)):
+        return False
+    for i in range(len(rtpath) - 1):
+        if rtpath[i] not in ('*', '?') and rtpath[i + 1] not in ('*', '?'):
+            return True
+    return False
+
+
+def write_lines(lines, filename, mode='w'):
+    """
+    将可迭代对象>lines<逐行写入文件，write_list的流式版本，输出格式与write_list相同
+
+    :return count: int
+        写入的行数
+    """
+    count = 0
+    with open(filename, mode) as f:
+        for line in lines:
+            if count > 0:
+                f.write('\n')
+            f.write(line)
+            count += 1
+    return count
+
+
+def truncate_torn_line(filename, block_size=1 << 16):
+    """
+    截掉只追加写入的文件末尾不完整的一行（没有换行符结尾），之后追加的内容不会与残行拼在一起
+        从文件末尾向前分块查找最后一个换行符，只读取文件的尾部
+
+    :return size: int
+        截断后的文件大小，即最后一个完整行之后的位置；文件不存在时返回0
+    """
+    if not os.path.exists(filename):
+        return 0
+    with open(filename, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - block_size)
+            f.seek(start)
+            i = f.read(end - start).rfind(b'\n')
+            if i >= 0:
+                end = start + i + 1
+                break
+            end = start
+        if end < size:
+            f.truncate(end)
+    return end
+
+
 class CodeTimer(object):
     """
     用上下文管理器计时
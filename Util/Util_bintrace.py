@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+列式存储的二进制trace文件（.btr），供IPBlockTopo和SubnetInference共用
+    文本格式的trace文件每次分析都要重新split，转换为二进制格式后，
+    读取时直接mmap，不必做任何文本解析，多个进程读同一个文件时还可以共享内存页
+
+文件结构（小端）：
+    magic       4字节，b'BTRC'
+    version     uint32
+    header_len  uint32
+    header      header_len字节的json，补齐到8字节对齐：
+                    format: 原始文本格式，'nmap'（IpTraceFileV2）或'tab'（SubnetInference）
+                    head: 原始文件的头部各行
+                    cleaned: 数据是否已经过预处理
+                    num_traces, num_hops
+                    arrays: {name: [offset, dtype, length]}
+    arrays      各列数据，每列都8字节对齐：
+                    dst      uint32[num_traces]    目标IP
+                    vp       uint32[num_traces]    vantage point
+                    flags    uint8[num_traces]     FLAG_REACHED, FLAG_MARKED
+                    offsets  uint64[num_traces+1]  第i条路径的跳在hops中的范围为[offsets[i], offsets[i+1])
+                    hops     uint32[num_hops]      每一跳的IP，ANONYMOUS（0）表示匿名IP（*），UNPROBED表示未探测的跳（?）
+                    rtts     float32[num_hops]     每一跳的时延，nan表示没有时延
+"""
+
+import os
+import json
+import shutil
+import struct
+import tempfile
+from array import array
+import numpy as np
+
+MAGIC = b'BTRC'
+VERSION = 1
+# 0.0.0.0不是合法的路由器接口地址（预处理时也会被替换为*），用来表示匿名IP
+ANONYMOUS = 0
+# 255.255.255.255同样不是合法的接口地址，用来表示没有发出探测包的跳（参见probe_engine.UNPROBED）
+UNPROBED = 0xFFFFFFFF
+# 路由路径中的标记 <-> hops中的取值
+MARKERS = {'*': ANONYMOUS, '?': UNPROBED}
+MARKER_NAMES = {ANONYMOUS: '*', UNPROBED: '?'}
+
+# flags
+FLAG_REACHED = 1  # 探测到达了目标IP（SubnetInference格式中以'+'开头的行）
+FLAG_MARKED = 2  # 原始数据中带有'+'/'-'标记
+
+ALIGNMENT = 8
+
+
+def align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class BinaryTraceWriter(object):
+    """
+    逐条加入路径，最后调用close()写出文件
+        各列在内存中只缓冲>block_size<个元素，写满后追加到该列的临时文件中，
+        close()时写出头部，再依次拷贝各列，内存占用与文件大小无关
+
+    example:
+        with BinaryTraceWriter('x.btr', fmt='nmap', head=head_lines, cleaned=True) as writer:
+            writer.add_trace(dst, vp, hops, rtts)
+    """
+    # (name, dtype, array typecode)
+    COLUMNS = [('dst', 'uint32', 'I'),
+               ('vp', 'uint32', 'I'),
+               ('flags', 'uint8', 'B'),
+               ('offsets', 'uint64', 'Q'),
+               ('hops', 'uint32', 'I'),
+               ('rtts', 'float32', 'f')]
+
+    def __init__(self, filename, fmt, head=(), cleaned=False, block_size=1 << 16):
+        self.filename = filename
+        self.fmt = fmt
+        self.head = list(head)
+        self.cleaned = cleaned
+        self.block_size = block_size
+        self.num_traces = 0
+        self.num_hops = 0
+        self.buffers = {name: array(typecode) for name, _, typecode in self.COLUMNS}
+        self.lengths = {name: 0 for name, _, _ in self.COLUMNS}
+        # 临时文件放在目标文件所在的目录，关闭后自动删除
+        spool_dir = os.path.dirname(os.path.abspath(filename))
+        self.spools = {name: tempfile.TemporaryFile(dir=spool_dir) for name, _, _ in self.COLUMNS}
+        self.buffers['offsets'].append(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.__close_spools()
+
+    def __len__(self):
+        return self.num_traces
+
+    def __flush(self, name, dtype):
+        data = self.buffers[name]
+        if data:
+            self.spools[name].write(np.asarray(data, dtype=dtype).astype('<' + np.dtype(dtype).str[1:]).tobytes())
+            self.lengths[name] += len(data)
+            del data[:]
+
+    def __close_spools(self):
+        for spool in self.spools.values():
+            spool.close()
+
+    def add_trace(self, dst, vp, hops, rtts=None, flags=0):
+        """
+        :param dst: int, 目标IP
+        :param vp: int, vantage point
+        :param hops: list of int, 匿名IP用ANONYMOUS表示
+        :param rtts: list of float, 与hops一一对应，None表示没有时延数据
+        :param flags: int, FLAG_REACHED | FLAG_MARKED
+        """
+        buffers = self.buffers
+        buffers['dst'].append(dst)
+        buffers['vp'].append(vp)
+        buffers['flags'].append(flags)
+        buffers['hops'].extend(hops)
+        if rtts is None:
+            buffers['rtts'].extend([float('nan')] * len(hops))
+        else:
+            buffers['rtts'].extend(rtts)
+        self.num_traces += 1
+        self.num_hops += len(hops)
+        buffers['offsets'].append(self.num_hops)
+        if len(buffers['hops']) >= self.block_size or len(buffers['dst']) >= self.block_size:
+            for name, dtype, _ in self.COLUMNS:
+                self.__flush(name, dtype)
+
+    def close(self):
+        for name, dtype, _ in self.COLUMNS:
+            self.__flush(name, dtype)
+
+        def encode_header(arrays):
+            return json.dumps({'format': self.fmt,
+                               'head': self.head,
+                               'cleaned': self.cleaned,
+                               'num_traces': self.num_traces,
+                               'num_hops': self.num_hops,
+                               'arrays': arrays}).encode('utf-8')
+
+        # 数组的偏移依赖于头部的长度，而头部中又记录了偏移：先用足够宽的占位偏移估计头部长度
+        arrays = {name: [1 << 62, dtype, self.lengths[name]] for name, dtype, _ in self.COLUMNS}
+        header_len = align(12 + len(encode_header(arrays))) - 12
+        offset = 12 + header_len
+        for name, dtype, _ in self.COLUMNS:
+            arrays[name][0] = offset
+            offset = align(offset + self.lengths[name] * np.dtype(dtype).itemsize)
+        header = encode_header(arrays)
+        header += b' ' * (header_len - len(header))
+
+        tmp_filename = self.filename + '.tmp'
+        try:
+            with open(tmp_filename, 'wb') as f:
+                f.write(MAGIC + struct.pack('<II', VERSION, header_len) + header)
+                for name, _, _ in self.COLUMNS:
+                    f.write(b'\0' * (arrays[name][0] - f.tell()))
+                    spool = self.spools[name]
+                    spool.seek(0)
+                    shutil.copyfileobj(spool, f)
+        finally:
+            self.__close_spools()
+        os.replace(tmp_filename, self.filename)
+
+
+class BinaryTraceFile(object):
+    """
+    mmap方式读取.btr文件，各列都是numpy数组视图，只有被访问到的页才会读入内存
+    """
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        with open(filename, 'rb') as f:
+            magic, version, header_len = struct.unpack('<4sII', f.read(12))
+            if magic != MAGIC:
+                raise ValueError('\"{0}\" is not a binary trace file.'.format(self.filename))
+            if version != VERSION:
+                raise ValueError('Unsupported binary trace version {0}.'.format(version))
+            self.header = json.loads(f.read(header_len).decode('utf-8'))
+
+        self.__mm = np.memmap(filename, dtype=np.uint8, mode='r')
+        for name, (offset, dtype, length) in self.header['arrays'].items():
+            setattr(self, name, np.frombuffer(self.__mm, dtype=np.dtype(dtype).newbyteorder('<'),
+                                              count=length, offset=offset))
+
+    @property
+    def fmt(self):
+        return self.header['format']
+
+    @property
+    def head(self):
+        return self.header['head']
+
+    @property
+    def cleaned(self):
+        return self.header['cleaned']
+
+    def __len__(self):
+        return self.header['num_traces']
+
+    def trace(self, i):
+        """
+        :return dst, vp, flags: int
+        :return hops: numpy.ndarray of uint32
+        :return rtts: numpy.ndarray of float32
+        """
+        start, stop = int(self.offsets[i]), int(self.offsets[i + 1])
+        return int(self.dst[i]), int(self.vp[i]), int(self.flags[i]), self.hops[start:stop], self.rtts[start:stop]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.trace(i)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+以原始数据文件的指纹（大小、修改时间、内容哈希）为键的缓存
+    原始文件一旦变化，之前生成的_cln文件、链路快照等缓存就全部失效
+"""
+
+import os
+import json
+import hashlib
+from contextlib import contextmanager
+import numpy as np
+
+
+def file_hash(filename, block_size=1 << 20):
+    # 文件内容的sha1
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class FileCache(object):
+    """
+    原始文件>filename<的缓存索引，保存在>filename<.cache中（json格式）：
+        {'size': ..., 'mtime_ns': ..., 'sha1': ..., 'entries': {name: path, ...}}
+
+    判断缓存是否有效：
+        1. 大小不同：失效
+        2. 大小、修改时间都相同：有效，不必读取文件内容（热启动只需一次stat）
+        3. 大小相同、修改时间不同（比如文件被touch或拷贝过）：比较内容哈希
+    """
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.meta_filename = self.filename + '.cache'
+
+    def __read_meta(self):
+        if not os.path.exists(self.meta_filename):
+            return None
+        try:
+            with open(self.meta_filename, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def __write_meta(self, meta):
+        tmp_filename = self.meta_filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_filename, self.meta_filename)
+
+    def __fresh_meta(self):
+        """ 返回与原始文件当前内容一致的缓存索引；若原始文件已变化，返回None """
+        meta = self.__read_meta()
+        if not meta or not os.path.exists(self.filename):
+            return None
+        st = os.stat(self.filename)
+        if st.st_size != meta['size']:
+            return None
+        if st.st_mtime_ns != meta['mtime_ns']:
+            if file_hash(self.filename) != meta['sha1']:
+                return None
+            # 内容没变，只是修改时间变了，更新索引以便下次直接命中
+            meta['mtime_ns'] = st.st_mtime_ns
+            self.__write_meta(meta)
+        return meta
+
+    def get(self, name):
+        """
+        :return path: string
+            名为>name<的有效缓存文件的路径；若缓存不存在或已失效，返回None
+        """
+        meta = self.__fresh_meta()
+        if meta is None:
+            return None
+        path = meta['entries'].get(name)
+        if path is None or not os.path.exists(path):
+            return None
+        return path
+
+    def put(self, name, path):
+        """
+        登记名为>name<的缓存文件>path<（应当在>path<完整写出之后调用）
+        若原始文件已变化，其他缓存项一并作废
+        """
+        meta = self.__fresh_meta()
+        if meta is None:
+            st = os.stat(self.filename)
+            meta = {'size': st.st_size,
+                    'mtime_ns': st.st_mtime_ns,
+                    'sha1': file_hash(self.filename),
+                    'entries': {}}
+        meta['entries'][name] = os.path.abspath(path)
+        self.__write_meta(meta)
+
+
+@contextmanager
+def atomic_filename(filename):
+    """
+    先写临时文件，完整写出后再改名为>filename<，不会留下不完整的缓存
+        写出过程中出现异常（或者被中断）时删除临时文件，>filename<保持原样
+
+    example:
+        with atomic_filename(clnfile) as tmp_filename:
+            Util.write_lines(lines, tmp_filename)
+    """
+    tmp_filename = filename + '.tmp'
+    try:
+        yield tmp_filename
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    os.replace(tmp_filename, filename)
+
+
+def save_arrays(filename, **arrays):
+    """
+    将若干numpy数组写入.npz文件（参见atomic_filename）
+    """
+    with atomic_filename(filename) as tmp_filename:
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, **arrays)
+
+
+def load_arrays(filename):
+    """
+    :return arrays: dict
+        key: 数组名
+        value: numpy.ndarray
+    """
+    with np.load(filename, allow_pickle=False) as data:
+        return {name: data[name] for name in data.files}
@@ -111,6 +111,71 @@ def remove_stubs(G, anchors):
     G.remove_nodes_from(nodes_to_remove)
 
 
+class DisjointSet(object):
+    """
+    并查集（union-find），按大小合并 + 路径减半，单次操作的均摊复杂度为O(alpha(n))
+    元素可以是任意hashable对象，内部用整数下标表示
+    """
+    def __init__(self, elements=()):
+        self.__index = {}
+        self.__elements = []
+        self.__parent = []
+        self.__size = []
+        for e in elements:
+            self.add(e)
+
+    def __len__(self):
+        return len(self.__elements)
+
+    def __contains__(self, e):
+        return e in self.__index
+
+    def add(self, e):
+        if e not in self.__index:
+            self.__index[e] = len(self.__elements)
+            self.__elements.append(e)
+            self.__parent.append(len(self.__parent))
+            self.__size.append(1)
+
+    def __find(self, i):
+        parent = self.__parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def find(self, e):
+        """ 返回>e<所在集合的代表元素 """
+        return self.__elements[self.__find(self.__index[e])]
+
+    def union(self, first, second):
+        """
+        合并>first<和>second<所在的集合，不存在的元素会被自动加入
+        :return: boolean, 二者原本不在同一集合时返回True
+        """
+        self.add(first)
+        self.add(second)
+        i, j = self.__find(self.__index[first]), self.__find(self.__index[second])
+        if i == j:
+            return False
+        if self.__size[i] < self.__size[j]:
+            i, j = j, i
+        self.__parent[j] = i
+        self.__size[i] += self.__size[j]
+        return True
+
+    def groups(self):
+        """
+        :return groups: dict
+            key: 集合的代表元素
+            value: list, 集合中的全部元素
+        """
+        groups = {}
+        for i, e in enumerate(self.__elements):
+            groups.setdefault(self.__elements[self.__find(i)], []).append(e)
+        return groups
+
+
 if __name__ == '__main__':
     edges = [(0, 1),
              (0, 4),
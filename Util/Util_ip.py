@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+IPv4地址的整数表示：点分十进制字符串 <-> uint32
+"""
+
+import ipaddress
+from bisect import bisect_right
+from functools import lru_cache
+from random import Random
+import numpy as np
+
+
+def ip_to_int(ip):
+    """
+    将点分十进制的IPv4地址转化为整数，比ipaddress.IPv4Address快得多
+
+    example:
+        ip_to_int('10.0.1.1') -> 167772417
+
+    :param ip: string
+        点分十进制的IPv4地址
+    :return: int
+    """
+    items = ip.split('.')
+    if len(items) != 4:
+        raise ValueError('Expected 4 octets in {0!r}'.format(ip))
+    n = 0
+    for item in items:
+        # 与ipaddress.IPv4Address的检查相同：只允许1~3个ASCII数字，不允许前导0
+        if not item:
+            raise ValueError('Empty octet not permitted in {0!r}'.format(ip))
+        if len(item) > 3 or not (item.isascii() and item.isdigit()):
+            raise ValueError('Only decimal digits permitted in {0!r} in {1!r}'.format(item, ip))
+        if len(item) > 1 and item[0] == '0':
+            raise ValueError('Leading zeros are not permitted in {0!r} in {1!r}'.format(item, ip))
+        octet = int(item)
+        if octet > 255:
+            raise ValueError('Octet {0} (> 255) not permitted in {1!r}'.format(octet, ip))
+        n = (n << 8) | octet
+    return n
+
+
+def int_to_ip(n):
+    """
+    将整数转化为点分十进制的IPv4地址
+
+    :param n: int
+    :return: string
+    """
+    return '%d.%d.%d.%d' % ((n >> 24) & 0xFF, (n >> 16) & 0xFF, (n >> 8) & 0xFF, n & 0xFF)
+
+
+def prefix_mask(prefix_length):
+    """ 前缀长度为>prefix_length<的网络掩码（整数） """
+    return (0xFFFFFFFF << (32 - prefix_length)) & 0xFFFFFFFF
+
+
+class IpInternTable(object):
+    """
+    IP地址的驻留表：同一个字符串只解析一次
+        trace文件中同一个接口会出现成千上万次，缓存解析结果可避免重复的split/int操作；
+        整数到字符串的转换不需要存储，直接用int_to_ip计算
+    """
+    def __init__(self):
+        self.__str2int = {}
+
+    def __len__(self):
+        return len(self.__str2int)
+
+    def intern(self, ip):
+        n = self.__str2int.get(ip)
+        if n is None:
+            n = ip_to_int(ip)
+            self.__str2int[ip] = n
+        return n
+
+    def intern_path(self, rtpath):
+        """ 将路由路径中的非匿名IP转为整数，匿名IP（*）、未探测的跳（?）以及已经是整数的IP保持不变 """
+        return [h if h == '*' or h == '?' or isinstance(h, int) else self.intern(h) for h in rtpath]
+
+    @staticmethod
+    def lookup(n):
+        return int_to_ip(n)
+
+
+def __special_networks():
+    """
+    可能影响ipaddress.IPv4Address.is_global结果的全部网络
+        包括ipaddress内部使用的网络（不同Python版本略有不同）和IANA登记的特殊用途地址块
+    """
+    networks = ['0.0.0.0/8', '10.0.0.0/8', '100.64.0.0/10', '127.0.0.0/8', '169.254.0.0/16',
+                '172.16.0.0/12', '192.0.0.0/24', '192.0.0.0/29', '192.0.0.8/32', '192.0.0.9/32',
+                '192.0.0.10/32', '192.0.0.170/31', '192.0.2.0/24', '192.31.196.0/24', '192.52.193.0/24',
+                '192.88.99.0/24', '192.168.0.0/16', '192.175.48.0/24', '198.18.0.0/15',
+                '198.51.100.0/24', '203.0.113.0/24', '224.0.0.0/4', '240.0.0.0/4', '255.255.255.255/32']
+    networks = [ipaddress.IPv4Network(net) for net in networks]
+    constants = getattr(ipaddress, '_IPv4Constants', None)
+    for name in ['_private_networks', '_private_networks_exceptions', '_reserved_network',
+                 '_multicast_network', '_public_network', '_linklocal_network', '_loopback_network']:
+        value = getattr(constants, name, None)
+        if value is None:
+            continue
+        networks.extend(value if isinstance(value, (list, tuple)) else [value])
+    return networks
+
+
+def __non_global_ranges():
+    """
+    非全局地址的区间表：按上述网络的边界把地址空间切成若干段，
+    is_global在每一段内都不变，用ipaddress判断每一段的第一个地址，再合并相邻的非全局段
+        因此结果与当前Python版本的ipaddress完全一致
+
+    :return: list of (start, end), 升序，闭区间
+    """
+    bounds = {0, 1 << 32}
+    for net in __special_networks():
+        bounds.add(int(net.network_address))
+        bounds.add(int(net.broadcast_address) + 1)
+    bounds = sorted(bounds)
+
+    ranges = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        if ipaddress.IPv4Address(start).is_global:
+            continue
+        if ranges and ranges[-1][1] == start - 1:
+            ranges[-1] = (ranges[-1][0], stop - 1)
+        else:
+            ranges.append((start, stop - 1))
+    return ranges
+
+
+NON_GLOBAL_RANGES = __non_global_ranges()
+__RANGE_STARTS = [start for start, _ in NON_GLOBAL_RANGES]
+__RANGE_ENDS = [end for _, end in NON_GLOBAL_RANGES]
+__RANGE_STARTS_ARRAY = np.array(__RANGE_STARTS, dtype=np.uint32)
+__RANGE_ENDS_ARRAY = np.array(__RANGE_ENDS, dtype=np.uint32)
+
+
+def is_global_int(n):
+    """ 与ipaddress.IPv4Address(n).is_global相同，但只需一次二分查找 """
+    i = bisect_right(__RANGE_STARTS, n) - 1
+    return i < 0 or n > __RANGE_ENDS[i]
+
+
+@lru_cache(maxsize=1 << 20)
+def is_global(ip):
+    """
+    与ipaddress.IPv4Address(ip).is_global相同
+        trace中同一个IP会反复出现，缓存判断结果
+    """
+    return is_global_int(ip_to_int(ip))
+
+
+def replace_non_global(rtpath):
+    """
+    将一条路由路径中的非全局IP（比如私有IP）替换为匿名IP（*），未探测的跳（?）保持不变
+
+    :param rtpath: list of strings
+    :return: list of strings
+    """
+    return [h if h == '?' or (h != '*' and is_global(h)) else '*' for h in rtpath]
+
+
+def global_mask(addresses):
+    """
+    批量判断，is_global_int的向量化版本
+
+    :param addresses: numpy.ndarray of uint32
+    :return: numpy.ndarray of bool
+    """
+    addresses = np.asarray(addresses, dtype=np.uint32)
+    i = np.searchsorted(__RANGE_STARTS_ARRAY, addresses, side='right') - 1
+    return (i < 0) | (addresses > __RANGE_ENDS_ARRAY[np.maximum(i, 0)])
+
+
+def host_range(network):
+    """
+    网络中可用主机地址的范围，与network.hosts()一致（/31、/32包括全部地址），
+    判断成员关系时只需比较两个整数，不必生成主机列表
+
+    example:
+        host_range(IPv4Network('10.0.1.0/24')) -> (167772417, 167772670)
+
+    :param network: ipaddress.IPv4Network or string
+    :return first, last: int, 闭区间
+    """
+    network = ipaddress.IPv4Network(network)
+    first, last = int(network.network_address), int(network.broadcast_address)
+    if network.prefixlen < 31:
+        first, last = first + 1, last - 1
+    return first, last
+
+
+class PrefixIndex(object):
+    """
+    一组IPv4前缀的有序区间索引：把地址映射到包含它的最长前缀
+        CIDR前缀之间只有嵌套或者不相交两种关系，预先把地址空间切分为互不相交的区间，
+        每个区间对应覆盖它的最长前缀，查询时只需一次二分查找，批量查询可以向量化
+    """
+    def __init__(self, prefixes, hosts_only=False):
+        """
+        :param prefixes: iterable of ipaddress.IPv4Network or strings
+            重复的前缀只保留第一个
+        :param hosts_only: boolean
+            True: 每个前缀只包括主机地址（参见host_range），否则包括全部地址
+                区间总是按全部地址划分（/31、/32的主机范围与外层前缀不一定是嵌套关系），
+                查到最长前缀之后，若地址不是该前缀的主机地址，则返回-1
+        """
+        self.prefixes = []
+        known = set()
+        for prefix in prefixes:
+            prefix = ipaddress.IPv4Network(prefix)
+            if prefix not in known:
+                known.add(prefix)
+                self.prefixes.append(prefix)
+
+        self.hosts_only = hosts_only
+        ranges = []
+        for i, prefix in enumerate(self.prefixes):
+            ranges.append((int(prefix.network_address), -int(prefix.broadcast_address), i))
+        # 按起点升序、终点降序排列，外层前缀总是先于其内层前缀
+        ranges.sort()
+
+        segments = []
+
+        def emit(start, end, i):
+            if start > end:
+                return
+            if segments and segments[-1][2] == i and segments[-1][1] == start - 1:
+                segments[-1] = (segments[-1][0], end, i)
+            else:
+                segments.append((start, end, i))
+
+        stack, pos = [], 0
+        for first, last, i in ranges:
+            last = -last
+            while stack and stack[-1][1] < first:
+                _, end, j = stack.pop()
+                emit(pos, end, j)
+                pos = end + 1
+            if stack:
+                emit(pos, first - 1, stack[-1][2])
+            pos = first
+            stack.append((first, last, i))
+        while stack:
+            _, end, j = stack.pop()
+            emit(pos, end, j)
+            pos = end + 1
+
+        self.__starts = [start for start, _, _ in segments]
+        self.__ends = [end for _, end, _ in segments]
+        self.__indices = [i for _, _, i in segments]
+        self.__starts_array = np.array(self.__starts, dtype=np.uint32)
+        self.__ends_array = np.array(self.__ends, dtype=np.uint32)
+        self.__indices_array = np.array(self.__indices, dtype=np.int64)
+        if hosts_only:
+            host_ranges = [host_range(prefix) for prefix in self.prefixes]
+            self.__host_first = [first for first, _ in host_ranges]
+            self.__host_last = [last for _, last in host_ranges]
+            self.__host_first_array = np.array(self.__host_first, dtype=np.uint32)
+            self.__host_last_array = np.array(self.__host_last, dtype=np.uint32)
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    def lookup(self, n):
+        """
+        :param n: int, 整数地址
+        :return: int, 包含>n<的最长前缀在self.prefixes中的下标；不存在时返回-1
+        """
+        k = bisect_right(self.__starts, n) - 1
+        if k < 0 or n > self.__ends[k]:
+            return -1
+        i = self.__indices[k]
+        if self.hosts_only and not self.__host_first[i] <= n <= self.__host_last[i]:
+            return -1
+        return i
+
+    def lookup_array(self, addresses):
+        """
+        批量查询，lookup的向量化版本
+
+        :param addresses: numpy.ndarray of uint32
+        :return: numpy.ndarray of int64
+        """
+        addresses = np.asarray(addresses, dtype=np.uint32)
+        if not self.__starts:
+            return np.full(len(addresses), -1, dtype=np.int64)
+        k = np.searchsorted(self.__starts_array, addresses, side='right') - 1
+        valid = (k >= 0) & (addresses <= self.__ends_array[np.maximum(k, 0)])
+        indices = self.__indices_array[np.maximum(k, 0)]
+        if self.hosts_only:
+            valid &= (addresses >= self.__host_first_array[indices]) & (addresses <= self.__host_last_array[indices])
+        return np.where(valid, indices, -1)
+
+    def prefix_of(self, ip):
+        """
+        :param ip: string or int
+        :return: ipaddress.IPv4Network, 包含>ip<的最长前缀；不存在时返回None
+        """
+        i = self.lookup(ip if isinstance(ip, int) else ip_to_int(ip))
+        return self.prefixes[i] if i >= 0 else None
+
+
+def _is_prime(n):
+    if n < 2:
+        return False
+    if n % 2 == 0:
+        return n == 2
+    i = 3
+    while i * i <= n:
+        if n % i == 0:
+            return False
+        i += 2
+    return True
+
+
+def _prime_factors(n):
+    factors, i = [], 2
+    while i * i <= n:
+        if n % i == 0:
+            factors.append(i)
+            while n % i == 0:
+                n //= i
+        i += 1
+    if n > 1:
+        factors.append(n)
+    return factors
+
+
+class HostPermutation(object):
+    """
+    网络中全部主机地址（与host_range一致）的伪随机排列，只占O(1)内存
+        取大于主机数n的最小素数p，以及模p乘法群的一个生成元g（原根），
+        x -> x * g mod p遍历1..p-1中的每个数恰好一次，跳过大于n的数即得到1..n的一个排列；
+        相同的>seed<总是得到相同的排列
+    分片：第i片（共k片）从第i步开始，每次前进k步（乘以g^k），各片互不重叠且合起来覆盖全部主机，
+    可以分给多个进程或者多台机器
+    """
+    def __init__(self, network, seed=0):
+        """
+        :param network: ipaddress.IPv4Network or string
+        :param seed: int or string
+        """
+        self.network = ipaddress.IPv4Network(network)
+        self.first, last = host_range(self.network)
+        self.num_hosts = last - self.first + 1
+        self.prime = self.num_hosts + 1
+        while not _is_prime(self.prime):
+            self.prime += 1
+
+        rand = Random(seed)
+        factors = _prime_factors(self.prime - 1)
+        while True:
+            g = rand.randint(1, self.prime - 1)
+            if self.prime == 2 or all(pow(g, (self.prime - 1) // q, self.prime) != 1 for q in factors):
+                break
+        self.generator = g
+        self.start = rand.randint(1, self.prime - 1)
+
+    def __len__(self):
+        return self.num_hosts
+
+    def __iter__(self):
+        return self.shard(0, 1)
+
+    def shard(self, index, count):
+        """
+        :param index: int, 分片编号，0 <= index < count
+        :param count: int, 分片总数
+        :return: generator of int, 本分片中的主机地址（整数）
+        """
+        p, n, first = self.prime, self.num_hosts, self.first
+        step = pow(self.generator, count, p)
+        x = self.start * pow(self.generator, index, p) % p
+        for _ in range(index, p - 1, count):
+            if x <= n:
+                yield first + x - 1
+            x = x * step % p
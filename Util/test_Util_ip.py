@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Util_ip的测试：结果必须与ipaddress一致
+
+    python -m pytest Util/test_Util_ip.py
+"""
+
+import os
+import sys
+import ipaddress
+from random import Random
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import Util_ip
+
+VALID = ['0.0.0.0', '10.0.1.1', '255.255.255.255', '1.2.3.4', '192.168.100.200']
+INVALID = ['', '1.2.3', '1.2.3.4.5', '01.2.3.4', '1.2.3.00', '1.2.3.256', '1.2.3.1000', '1..3.4', '1.2.3.',
+           ' 1.2.3.4', '1.2.3.4 ', '1.2. 3.4', '+1.2.3.4', '-1.2.3.4', '1_0.2.3.4', '1.2.3.a', '１.2.3.4', '².2.3.4']
+
+
+@pytest.mark.parametrize('ip', VALID)
+def test_ip_to_int_valid(ip):
+    assert Util_ip.ip_to_int(ip) == int(ipaddress.IPv4Address(ip))
+    assert Util_ip.int_to_ip(Util_ip.ip_to_int(ip)) == ip
+
+
+@pytest.mark.parametrize('ip', INVALID)
+def test_ip_to_int_rejects_what_ipaddress_rejects(ip):
+    with pytest.raises(ValueError):
+        ipaddress.IPv4Address(ip)
+    with pytest.raises(ValueError):
+        Util_ip.ip_to_int(ip)
+
+
+def longest_prefix(prefixes, n, hosts_only):
+    """ PrefixIndex.lookup的逐个比较版本 """
+    best = -1
+    for i, prefix in enumerate(prefixes):
+        if int(prefix.network_address) <= n <= int(prefix.broadcast_address):
+            if best < 0 or prefix.prefixlen > prefixes[best].prefixlen:
+                best = i
+    if best >= 0 and hosts_only:
+        first, last = Util_ip.host_range(prefixes[best])
+        if not first <= n <= last:
+            return -1
+    return best
+
+
+@pytest.mark.parametrize('hosts_only', [False, True])
+def test_prefix_index_overlapping_slash31_at_boundary(hosts_only):
+    # /31的主机范围（全部两个地址）越过了/24主机范围的末端
+    index = Util_ip.PrefixIndex(['10.0.0.0/24', '10.0.0.254/31', '10.0.0.0/31', '10.0.0.128/32'], hosts_only=hosts_only)
+    prefixes = index.prefixes
+    addresses = range(Util_ip.ip_to_int('9.255.255.250'), Util_ip.ip_to_int('10.0.1.5'))
+    expected = [longest_prefix(prefixes, n, hosts_only) for n in addresses]
+    assert [index.lookup(n) for n in addresses] == expected
+    assert index.lookup_array(list(addresses)).tolist() == expected
+    assert index.lookup(Util_ip.ip_to_int('10.0.0.254')) == 1
+    assert index.lookup(Util_ip.ip_to_int('10.0.0.255')) == 1
+    assert index.lookup(Util_ip.ip_to_int('10.0.0.253')) == 0
+
+
+@pytest.mark.parametrize('hosts_only', [False, True])
+def test_prefix_index_matches_brute_force(hosts_only):
+    rand = Random(7)
+    prefixes = [ipaddress.IPv4Network((rand.choice([0x0A000000, 0x0A000100]) + rand.randrange(512),
+                                       rand.choice([22, 23, 24, 26, 29, 30, 31, 32])), strict=False)
+                for _ in range(60)]
+    index = Util_ip.PrefixIndex(prefixes, hosts_only=hosts_only)
+    addresses = range(0x09FFFFF0, 0x0A000410)
+    expected = [longest_prefix(index.prefixes, n, hosts_only) for n in addresses]
+    assert [index.lookup(n) for n in addresses] == expected
+    assert index.lookup_array(list(addresses)).tolist() == expected